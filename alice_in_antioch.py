@@ -1,53 +1,305 @@
+import math
+import os
+import pickle
 import random
-from collections import deque
-from copy import deepcopy
+import time
+from array import array
+from collections import OrderedDict
+from copy import copy, deepcopy
+from itertools import chain, repeat
+
+try:
+    import numpy
+except ImportError:  # Batched rollouts are optional
+    numpy = None  # type: ignore
 
 random.seed(1)
 
 class DoneInteracting(Exception):
     pass
 
+class Column:
+    # A persistent array of numbers split into chunks. Copies share every chunk, and writing to a copy
+    # replaces only the chunk written to, so a world step pays for the entities it changes rather than
+    # for the whole column.
+    __slots__ = ("typecode", "chunks", "owned", "length")
+    chunk_size = 64
+
+    def __init__(self, typecode, values=()):
+        self.typecode = typecode
+        self.chunks = []
+        self.owned = set()  # Chunks no copy shares, which can be written in place
+        self.length = 0
+        for value in values:
+            self.append(value)
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, index):
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        return self.chunks[index // self.chunk_size][index % self.chunk_size]
+
+    def __setitem__(self, index, value):
+        if not 0 <= index < self.length:
+            raise IndexError(index)
+        self.writable(index // self.chunk_size)[index % self.chunk_size] = value
+
+    def writable(self, chunk):
+        # The chunk at this position, copied first if it may be shared
+        if chunk not in self.owned:
+            self.chunks[chunk] = array(self.typecode, self.chunks[chunk])
+            self.owned.add(chunk)
+        return self.chunks[chunk]
+
+    def __iter__(self):
+        return chain.from_iterable(self.chunks)
+
+    def append(self, value):
+        if self.length % self.chunk_size == 0:
+            self.chunks.append(array(self.typecode))
+            self.owned.add(len(self.chunks) - 1)
+        elif len(self.chunks) - 1 not in self.owned:
+            self.chunks[-1] = array(self.typecode, self.chunks[-1])
+            self.owned.add(len(self.chunks) - 1)
+        self.chunks[-1].append(value)
+        self.length += 1
+
+    def copy(self):
+        # Neither column may write to the chunks they now share
+        column = copy(self)
+        column.chunks = list(self.chunks)
+        column.owned = set()
+        self.owned = set()
+        return column
+
+    def tobytes(self):
+        return b"".join(chunk.tobytes() for chunk in self.chunks)
+
 class World:
-    def __init__(self):
+    # Worlds are persistent and stored as copy-on-write columns indexed by entity id. A step shares
+    # everything it doesn't change, including the entity records themselves, which are never mutated
+    # once inserted.
+    deterministic = True  # Stepping the same world with the same actions always gives the same result
+
+    def __init__(self, graph=None):
         self.main_character = None
-        self.entity_lookup = {}  # Indexed by entity name
-        self.entity_locations = {}  # Indexed by entity name
+        self.graph = graph if graph is not None else LocationGraph()  # Shared by every step of this world
+        self.entity_ids = {}  # Indexed by entity name
+        self.entities = []  # Indexed by entity id
+        self.locations = Column("i")  # Indexed by entity id, holds node ids in graph
+        self.fatigue = Column("d")  # Indexed by entity id
+        # Minds' satisfaction is kept as a running total per world. A stepped world knows the totals of
+        # the world it was stepped from and which entities' columns the step changed, so only goals
+        # on those are re-evaluated. changed is None when anything might have changed.
+        self.changed = None  # Attribute ("location" or "fatigue") -> ids of entities whose value changed
+        self.inherited = None  # The totals of the world this one was stepped from
+        self.totals = {}  # CompiledGoals -> (satisfaction of each goal, total)
 
     def __str__(self):
-        return str(["{} at {}".format(self.entity_lookup[x], self.entity_locations[x]) for x in self.entity_lookup])
+        return str(["{} at {}".format(entity, self.graph.locations[node])
+                     for entity, node in zip(self.entities, self.locations)])
 
     def insert_entity(self, entity, location):
-        self.entity_lookup[str(entity)] = entity
-        self.entity_locations[str(entity)] = location
+        # The id table may be shared with other worlds, so it is copied rather than extended in place
+        self.entity_ids = dict(self.entity_ids)
+        self.entity_ids[str(entity)] = len(self.entities)
+        self.entities = self.entities + [entity]
+        self.locations = self.locations.copy()
+        self.locations.append(self.graph.add(location))
+        self.fatigue = self.fatigue.copy()
+        self.fatigue.append(entity.fatigue)
+        self.changed = None
+        self.inherited = None
+        self.totals = {}
+
+    def for_rollouts(self):
+        # A copy to imagine rollouts in elsewhere. Stepping and scoring read only the columns, so the
+        # entity records (whose minds hold whole world models of their own) are left behind.
+        world = copy(self)
+        world.main_character = None
+        world.entities = [None] * len(self.entities)
+        world.changed = None
+        world.inherited = None
+        world.totals = {}
+        return world
+
+    def fork(self):
+        next_world = copy(self)
+        next_world.locations = self.locations.copy()
+        next_world.fatigue = self.fatigue.copy()
+        next_world.changed = {"location": [], "fatigue": []}
+        next_world.inherited = self.totals
+        next_world.totals = {}
+        return next_world
 
     def step(self, entity_actions):
-        next_world = deepcopy(self)
-        for entity_name in entity_actions:
-            action = entity_actions[entity_name]
+        return self.apply_each((self.entity_ids[entity_name], action) for entity_name, action in entity_actions.items()
+                               if action is not None)
+
+    def collect_actions(self):
+        return [entity.act(self) for entity in self.entities]
+
+    def apply(self, actions):
+        # actions is indexed by entity id, with None for entities that do nothing
+        return self.apply_each((entity_id, action) for entity_id, action in enumerate(actions) if action is not None)
+
+    def apply_each(self, actions):
+        # actions are (entity id, action) pairs, for only the entities that act
+        next_world = self.fork()
+        locations = next_world.locations
+        fatigue = next_world.fatigue
+        moved = next_world.changed["location"]
+        tired = next_world.changed["fatigue"]
+        adjacency = self.graph.adjacency
+        moves = self.graph.moves
+        chunk_size = Column.chunk_size
+        for entity_id, action in actions:
+            chunk, offset = divmod(entity_id, chunk_size)
             if action.summary != "wait":
-                next_world.get_entity(entity_name).fatigue += 0.1
-            if action.summary == "go north":
-                try:
-                    new_location = self.entity_locations[entity_name].north
-                    next_world.entity_locations[entity_name] = new_location
-                except AttributeError:
-                    pass
+                fatigue.writable(chunk)[offset] += 0.1
+                tired.append(entity_id)
+            direction = moves.get(action.summary)
+            if direction is not None:
+                node = locations.chunks[chunk][offset]
+                neighbour = adjacency[node * 4 + direction]
+                if neighbour >= 0 and neighbour != node:
+                    locations.writable(chunk)[offset] = neighbour
+                    moved.append(entity_id)
         return next_world
 
+    def tick(self):
+        return self.apply(self.collect_actions())
+
     def location_of(self, entity_name):
-        return self.entity_locations[entity_name]
+        return self.graph.locations[self.locations[self.entity_ids[entity_name]]]
+
+    def node_of(self, entity_name):
+        return self.locations[self.entity_ids[entity_name]]
+
+    def attribute_of(self, entity_name, attribute):
+        return self.value_of(self.entity_ids[entity_name], attribute)
+
+    def value_of(self, entity_id, attribute):
+        if attribute == "location":
+            return self.locations[entity_id]
+        elif attribute == "fatigue":
+            return self.fatigue[entity_id]
+        return getattr(self.entities[entity_id], attribute)
+
+    def state_key(self):
+        # Everything step can change, in a canonical order
+        return tuple(self.entity_ids), self.locations.tobytes(), self.fatigue.tobytes()
 
     def get_entity(self, entity_name):
-        return self.entity_lookup[entity_name]
+        entity_id = self.entity_ids[entity_name]
+        entity = self.entities[entity_id]
+        if entity.fatigue != self.fatigue[entity_id]:
+            # Records keep the fatigue they were inserted with, so hand out one matching this world
+            entity = copy(entity)
+            entity.fatigue = self.fatigue[entity_id]
+        return entity
+
+class LocationGraph:
+    # Locations are nodes with integer ids. Each has a slot per compass direction in a flat
+    # adjacency array, and shortest distances between every pair are indexed on demand.
+    directions = ("north", "east", "south", "west")
+    moves = {"go " + direction: i for i, direction in enumerate(directions)}  # Indexed by action summary
+    unreachable = 2 ** 31 - 1
+
+    def __init__(self):
+        self.locations = []  # Indexed by node id
+        self.node_ids = {}  # Indexed by location
+        self.adjacency = array("i")  # Indexed by node id * 4 + direction; -1 where there is no way through
+        self.distances = None  # Indexed by origin * len(locations) + destination
+
+    def add(self, location):
+        if location not in self.node_ids:
+            self.node_ids[location] = len(self.locations)
+            self.locations.append(location)
+            self.adjacency.extend([-1] * len(self.directions))
+            self.distances = None
+        return self.node_ids[location]
+
+    def connect(self, origin, direction, destination):
+        # Paths can always be walked back the other way
+        origin_id = self.add(origin)
+        destination_id = self.add(destination)
+        direction = self.directions.index(direction)
+        self.adjacency[origin_id * 4 + direction] = destination_id
+        self.adjacency[destination_id * 4 + (direction + 2) % 4] = origin_id
+        self.distances = None
+
+    def distance(self, origin, destination):
+        if self.distances is None:
+            self.distances = self.shortest_paths()
+        return self.distances[origin * len(self.locations) + destination]
+
+    def nodes_named(self, name):
+        return tuple([node for node, location in enumerate(self.locations) if location.name == name])
+
+    def distance_to_any(self, origin, destinations):
+        return min([self.distance(origin, node) for node in destinations], default=self.unreachable)
+
+    def shortest_paths(self):
+        # A breadth-first search from every node
+        size = len(self.locations)
+        distances = array("i", [self.unreachable]) * (size * size)
+        for origin in range(size):
+            distances[origin * size + origin] = 0
+            frontier = [origin]
+            while frontier:
+                next_frontier = []
+                for node in frontier:
+                    for neighbour in self.adjacency[node * 4:node * 4 + 4]:
+                        if neighbour >= 0 and distances[origin * size + neighbour] == self.unreachable:
+                            distances[origin * size + neighbour] = distances[origin * size + node] + 1
+                            next_frontier.append(neighbour)
+                frontier = next_frontier
+        return distances
+
+class TranspositionTable:
+    # Bounded LRU cache of imagined futures, keyed by the state a mind's goals depend on and what
+    # remains of a policy
+    def __init__(self, max_size):
+        self.max_size = max_size
+        self.entries = OrderedDict()
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        value = self.entries.get(key)
+        if value is not None:
+            self.entries.move_to_end(key)
+        return value
+
+    def put(self, key, value):
+        self.entries[key] = value
+        self.entries.move_to_end(key)
+        if len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def clear(self):
+        self.entries.clear()
 
 class Location:
+    # Locations, actions and goals are immutable values, so copies of a world or a mind share them
+    __slots__ = ("name",)
+
     def __init__(self, name):
         self.name = name
 
     def __str__(self):
         return self.name
 
+    def __deepcopy__(self, memo):
+        return self
+
 class Body:
+    __slots__ = ("mind", "fatigue")
+
     def __init__(self, mind):
         self.mind = mind
         self.fatigue = 0
@@ -66,17 +318,42 @@ class Sensation:
         pass
 
 class Mind:
+    __slots__ = ("name", "goals", "possible_actions", "internal_clock", "policy", "recent_policies", "world_model",
+                 "self_model", "surprise_threshold", "batch_rollouts", "transposition_table", "keep_transpositions",
+                 "executor", "rollout_chunk_size", "prune_hopeless", "search_breadth", "search_depth", "time_budget",
+                 "rollout_budget", "search", "allocator", "samples_spent", "compiled_goals")
+
     def __init__(self, name):
         self.name = name
         self.goals = set()
         self.possible_actions = set()
         self.internal_clock = 0
         self.policy = None
-        self.recent_policies = deque(maxlen=3)
+        self.recent_policies = ()  # The last three chosen, oldest first
         self.world_model = World()
         self.self_model = Body(self)
         self.world_model.insert_entity(self.self_model, Location("Somewhere"))
         self.surprise_threshold = 10  # TODO WAT
+        self.batch_rollouts = False  # Simulate all rollouts of a decision at once (needs numpy)
+        self.transposition_table = TranspositionTable(100000)
+        self.keep_transpositions = False  # Reuse imagined futures across decisions (clear it if goals change)
+        self.executor = None  # Serial, or a concurrent.futures executor to spread rollouts over
+        self.rollout_chunk_size = 0  # Rollouts per task sent to the executor; 0 shares them out, one task per core
+        self.prune_hopeless = False  # Abandon serial rollouts that provably can't beat the best so far
+        self.search_breadth = 1000
+        self.search_depth = 10
+        self.time_budget = None  # Seconds of planning per act; None plans each decision to completion
+        self.rollout_budget = None  # Rollouts per act; None plans each decision to completion
+        self.search = None  # A decision still being planned, carried over between acts
+        self.allocator = Search  # How rollouts are shared between candidates: Search (round-robin) or UCB1Search
+        self.samples_spent = {}  # Rollouts given to each candidate policy in the last decision
+        self.compiled_goals = None  # The goals as last compiled against a world's entity ids
+
+    def __getstate__(self):
+        # Executors can't be pickled or copied; copies of a mind plan serially
+        state = {attribute: getattr(self, attribute) for attribute in self.__slots__}
+        state["executor"] = None
+        return None, state
 
     def __str__(self):
         return "{}'s mind".format(self.name)
@@ -89,19 +366,108 @@ class Mind:
                 policies.append(Policy([act1, act2], self.internal_clock))
         return policies
 
-    def imagine(self, world_model, policy, search_depth):
-        reward_sum = 0
+    def imagine(self, world_model, policy, search_depth, cutoff=None):
+        # Returns None if the rollout was abandoned because it could not score above cutoff
+        return self.rollouts(world_model, self.transposition_table).imagine(world_model, policy, search_depth, cutoff)
+
+    def rollouts(self, world_model, transposition_table):
+        return Rollouts(str(self.self_model), self.compile_goals(world_model), self.planning_time(), transposition_table)
+
+    def imagine_all(self, world_model, policies, search_depth, known_scores=None):
+        # A deterministic policy in a deterministic world always scores the same, so it is only
+        # simulated once and its score reused for the rest of its samples (and kept in known_scores)
+        if known_scores is None:
+            known_scores = {}
+        rollouts = []
+        seen = set()
+        for policy in policies:
+            if world_model.deterministic and policy.deterministic:
+                if policy in seen or policy in known_scores:
+                    continue
+                seen.add(policy)
+            rollouts.append(policy)
+
+        if self.batch_rollouts and numpy is not None:
+            simulated = iter(self.imagine_batch(world_model, rollouts, search_depth))
+        elif self.executor is not None:
+            # map yields chunks in submission order, so scores merge exactly as if run serially
+            chunk_size = self.rollout_chunk_size or max(1, -(-len(rollouts) // (os.cpu_count() or 1)))
+            chunks = [rollouts[i:i + chunk_size] for i in range(0, len(rollouts), chunk_size)]
+            # Tasks are sent only what a rollout needs, not the whole mind and its transposition table,
+            # pickled once per decision and unpickled once per worker
+            payload = pickle.dumps((self.rollouts(world_model, None), world_model.for_rollouts()))
+            simulated = chain.from_iterable(self.executor.map(
+                imagine_chunk, repeat(payload), repeat(self.transposition_table.max_size), chunks, repeat(search_depth)))
+        else:
+            simulated = self.imagine_each(world_model, rollouts, search_depth)
+
+        scores = []
+        for policy in policies:
+            if policy not in known_scores:
+                score = next(simulated)
+                if policy in seen:
+                    known_scores[policy] = score
+            else:
+                score = known_scores[policy]
+            scores.append(score)
+        return scores
+
+    def imagine_each(self, world_model, policies, search_depth):
+        best_score = None
+        for policy in policies:
+            score = self.imagine(world_model, policy, search_depth, best_score if self.prune_hopeless else None)
+            if score is not None and (best_score is None or score > best_score):
+                best_score = score
+            yield score
+
+    def imagine_batch(self, world_model, policies, search_depth):
+        # Same scores as imagine, but every rollout is stepped together as arrays following the
+        # transition rules of World.step. Only the self model acts, and policies are open-loop.
+        name = str(self.self_model)
+        adjacency = numpy.array(world_model.graph.adjacency).reshape(-1, 4)
+
+        unique_policies = {policy: row for row, policy in enumerate(dict.fromkeys(policies))}
+        start_time = self.planning_time()
+        summaries = [[policy.act(world_model, start_time + t).summary for t in range(search_depth)]
+                     for policy in unique_policies]
+        rows = numpy.array([unique_policies[policy] for policy in policies])
+        moves = numpy.array([[world_model.graph.moves.get(summary, -1) for summary in row] for row in summaries])[rows]
+        tiring = numpy.array([[summary != "wait" for summary in row] for row in summaries], dtype=bool)[rows]
+
+        position = numpy.full(len(policies), world_model.node_of(name))
+        fatigue = numpy.full(len(policies), world_model.attribute_of(name, "fatigue"))
+        reward_sum = numpy.zeros(len(policies))
         discount_factor = 0.9
-        imagined_time = self.internal_clock
         for t in range(search_depth):
-            act = policy.act(world_model, imagined_time + t)
-            world_model = world_model.step({str(self.self_model): act})
-            reward_sum += self.satisfaction(world_model) * discount_factor
+            fatigue = numpy.where(tiring[:, t], fatigue + 0.1, fatigue)
+            neighbour = adjacency[position, moves[:, t]]
+            position = numpy.where((moves[:, t] >= 0) & (neighbour >= 0), neighbour, position)
+            reward_sum += self.satisfaction_batch(world_model, position, fatigue) * discount_factor
             discount_factor = discount_factor * discount_factor
-        return reward_sum
+        return reward_sum.tolist()
+
+    def compile_goals(self, world):
+        # Recompiled only when the goals change, the world's entities are numbered differently or it
+        # has new locations
+        compiled = self.compiled_goals
+        if (compiled is None or compiled.entity_ids is not world.entity_ids or compiled.node_count != len(world.graph.locations)
+                or compiled.goal_set != self.goals):
+            compiled = self.compiled_goals = CompiledGoals(self.goals, world)
+        return compiled
 
     def satisfaction(self, world):
-        return sum([goal.satisfaction(world) for goal in self.goals])
+        return self.compile_goals(world).satisfaction(world)
+
+    def planning_time(self):
+        # Rollouts of a decision carried over between acts are imagined from when it started, so
+        # every sample of a policy scores the same plan
+        return self.search.start_time if self.search is not None else self.internal_clock
+
+    def satisfaction_batch(self, world_model, position, fatigue):
+        satisfaction = numpy.zeros(len(position))
+        for goal in self.goals:
+            satisfaction = satisfaction + goal.satisfaction_batch(world_model, str(self.self_model), position, fatigue)
+        return satisfaction
 
     def act(self, sensation):
         self.internal_clock += 1
@@ -110,29 +476,167 @@ class Mind:
 
         if self.policy and surprise > self.surprise_threshold:
             self.policy = None
+            self.search = None
 
-        if not self.policy:
-            possible_policies = self.generate_possible_policies()
-            score_estimates = {policy: (0, -9999999) for policy in possible_policies}
-            search_breadth = 1000
-            search_depth = 10
-            for i in range(search_breadth):
-                policy = possible_policies[i % len(possible_policies)]
-                score = self.imagine(self.world_model, policy, search_depth)
-                prev_samples, prev_score = score_estimates[policy]
-                new_samples = prev_samples + 1
-                new_score = (prev_score * (prev_samples / new_samples)) + score / new_samples
-                score_estimates[policy] = (new_samples, new_score)
-            self.policy = max(possible_policies, key=lambda x: score_estimates[x])
-            print("Selecting: " + str(self.policy))
-            self.recent_policies.append(self.policy)
+        if not self.policy or self.search is not None:
+            self.plan()
 
         return self.policy.act(self.world_model, self.internal_clock) if self.policy else None
 
+    def plan(self):
+        # Spends at most this act's budget on the current decision. The policy is always the best found
+        # so far; it is only final (and remembered) once every rollout of the decision is done.
+        if self.search is None:
+            if not self.keep_transpositions:
+                self.transposition_table.clear()
+            self.search = self.allocator(self.generate_possible_policies(), self.search_breadth, self.internal_clock)
+        search = self.search
+
+        deadline = None if self.time_budget is None else time.perf_counter() + self.time_budget
+        budget = search.breadth - search.done
+        if self.rollout_budget is not None:
+            if self.rollout_budget < 1:
+                raise ValueError("A rollout budget must allow at least one rollout per act")
+            budget = min(budget, self.rollout_budget)
+        while budget > 0:
+            # Under a deadline, check the clock after every round of the candidates. The first round
+            # always runs, so every act makes progress however little time it has.
+            rollouts = search.next_rollouts(budget if deadline is None else min(budget, len(search.policies)))
+            for policy, score in zip(rollouts, self.imagine_all(self.world_model, rollouts, self.search_depth, search.known_scores)):
+                search.record(policy, score)
+            search.done += len(rollouts)
+            budget -= len(rollouts)
+            if deadline is not None and time.perf_counter() >= deadline:
+                break
+
+        self.policy = search.best()
+        if search.done == search.breadth:
+            print("Selecting: " + str(self.policy))
+            self.recent_policies = self.recent_policies[-2:] + (self.policy,)
+            self.samples_spent = {policy: search.score_estimates[policy][0] for policy in search.policies}
+            self.search = None
+
     def update_from(self, sensation):
         return 0
 
+class Search:
+    # Round-robin rollouts for one decision and the running mean score of each candidate policy
+    def __init__(self, policies, breadth, start_time=0):
+        self.policies = policies
+        self.score_estimates = {policy: (0, -9999999) for policy in policies}
+        self.breadth = breadth
+        self.start_time = start_time  # The mind's clock when the decision started
+        self.done = 0
+        self.pruned = set()
+        self.known_scores = {}  # Scores of deterministic policies, kept for the whole decision
+
+    def next_rollouts(self, count):
+        return [self.policies[i % len(self.policies)] for i in range(self.done, self.done + count)]
+
+    def record(self, policy, score):
+        if score is None:  # Pruned, so it can't be the best policy
+            self.pruned.add(policy)
+            return
+        prev_samples, prev_score = self.score_estimates[policy]
+        new_samples = prev_samples + 1
+        new_score = (prev_score * (prev_samples / new_samples)) + score / new_samples
+        self.score_estimates[policy] = (new_samples, new_score)
+
+    def best(self):
+        return max(self.policies, key=lambda x: self.score_estimates[x])
+
+class UCB1Search(Search):
+    # Tries every candidate once, then gives each rollout to the candidate with the highest upper
+    # confidence bound on its score, so hopeless policies stop being sampled. The best policy is the
+    # one with the highest mean score.
+    exploration = 1.0
+
+    def next_rollouts(self, count):
+        untried = [policy for policy in self.policies
+                   if self.score_estimates[policy][0] == 0 and policy not in self.pruned]
+        if untried:
+            return untried[:count]
+        candidates = [policy for policy in self.policies if policy not in self.pruned]
+        if not candidates:
+            return self.policies[:count]
+        return [max(candidates, key=self.upper_confidence_bound)]
+
+    def upper_confidence_bound(self, policy):
+        samples, score = self.score_estimates[policy]
+        return score + self.exploration * math.sqrt(2 * math.log(self.done) / samples)
+
+    def best(self):
+        return max(self.policies, key=lambda x: self.score_estimates[x][1])
+
+class Rollouts:
+    # What imagining a rollout needs from a mind: who acts, their compiled goals, when the plans
+    # start and where to memoize futures. Small enough to send with every task to an executor.
+    __slots__ = ("actor", "goals", "start_time", "transposition_table")
+
+    def __init__(self, actor, goals, start_time, transposition_table):
+        self.actor = actor
+        self.goals = goals
+        self.start_time = start_time
+        self.transposition_table = transposition_table
+
+    def imagine(self, world_model, policy, search_depth, cutoff=None):
+        # Returns None if the rollout was abandoned because it could not score above cutoff
+        reward_sum = 0
+        discount_factor = 0.9
+        imagined_time = self.start_time
+        # Deterministic futures are memoized as the rewards of every remaining step, so a rollout that
+        # reaches a known (state, plan, step) can stop simulating and still sum rewards in the same order
+        memoize = world_model.deterministic and policy.deterministic
+        actor_id = world_model.entity_ids[self.actor]
+        rewards = []
+        keys = []
+        for t in range(search_depth):
+            if memoize:
+                key = (self.goals.state_key(world_model, actor_id), policy.plan_from(imagined_time + t), t, search_depth)
+                known_rewards = self.transposition_table.get(key)
+                if known_rewards is not None:
+                    rewards.extend(known_rewards)
+                    break
+                keys.append(key)
+            act = policy.act(world_model, imagined_time + t)
+            world_model = world_model.step({self.actor: act})
+            rewards.append(self.goals.satisfaction(world_model) * discount_factor)
+            discount_factor = discount_factor * discount_factor
+            if cutoff is not None:
+                if sum(rewards) + self.optimistic_value(world_model, discount_factor, search_depth - t - 1) < cutoff:
+                    return None
+        for t, key in enumerate(keys):
+            self.transposition_table.put(key, tuple(rewards[t:]))
+        for reward in rewards:
+            reward_sum += reward
+        return reward_sum
+
+    def optimistic_value(self, world_model, discount_factor, steps):
+        # Upper bound on the rewards of the next steps of a rollout starting from world_model
+        bounds = self.goals.optimistic_bounds(world_model)
+        value = 0
+        for step in range(1, steps + 1):
+            value += sum([worth if distance <= step else 0 for distance, worth in bounds]) * discount_factor
+            discount_factor = discount_factor * discount_factor
+        return value
+
+# In an executor's workers, the last decision's payload and what it unpickles to
+ROLLOUT_PAYLOADS = {}  # type: dict
+
+def imagine_chunk(payload, table_size, policies, search_depth):
+    # Each task memoizes into a table of its own, so tasks running on threads never share one
+    unpickled = ROLLOUT_PAYLOADS.get(payload)
+    if unpickled is None:
+        ROLLOUT_PAYLOADS.clear()
+        unpickled = ROLLOUT_PAYLOADS[payload] = pickle.loads(payload)
+    rollouts, world_model = unpickled
+    rollouts = Rollouts(rollouts.actor, rollouts.goals, rollouts.start_time, TranspositionTable(table_size))
+    return [rollouts.imagine(world_model, policy, search_depth) for policy in policies]
+
 class Policy:
+    deterministic = True  # act depends only on the time
+    __slots__ = ("sequence", "start_time")
+
     def __init__(self, sequence, start_time):
         self.sequence = sequence
         self.start_time = start_time
@@ -145,23 +649,125 @@ class Policy:
         index = min(max(index, 0), len(self.sequence) - 1)
         return self.sequence[index]
 
+    def plan_from(self, time):
+        index = time - self.start_time
+        index = min(max(index, 0), len(self.sequence) - 1)
+        return tuple(self.sequence[index:])
+
 class Goal:
+    __slots__ = ("subject", "relation", "object")
+
     def __init__(self, subject, relation, object):
         self.subject = subject
         self.relation = relation
         self.object = object
 
+    def __deepcopy__(self, memo):
+        return self
+
     def satisfaction(self, world_model):
+        return self.evaluate(world_model, world_model.entity_ids[self.subject])
+
+    def dependency(self):
+        # The attribute of the subject that satisfaction depends on
         if self.relation == "is in":
-            if world_model.location_of(self.subject).name == self.object.name:
+            return "location"
+        elif self.relation == "has low":
+            return self.object
+        raise NotImplementedError()
+
+    def evaluate(self, world_model, entity_id):
+        # satisfaction, with the subject already looked up
+        if self.relation == "is in":
+            if world_model.graph.locations[world_model.locations[entity_id]].name == self.object.name:
                 return 1
             else:
                 return 0
         elif self.relation == "has low":
-            return max(0, 1 - getattr(world_model.get_entity(self.subject), self.object))
+            if self.object == "fatigue":
+                return max(0, 1 - world_model.fatigue[entity_id])
+            return max(0, 1 - getattr(world_model.entities[entity_id], self.object))
+        raise NotImplementedError()
+
+    def satisfaction_batch(self, world_model, actor, position, fatigue):
+        # Entities other than the actor, and attributes other than fatigue, are fixed during a rollout
+        if self.subject != actor:
+            return self.satisfaction(world_model)
+        if self.relation == "is in":
+            locations = world_model.graph.locations
+            return numpy.array([location.name == self.object.name for location in locations], dtype=int)[position]
+        elif self.relation == "has low":
+            if self.object == "fatigue":
+                return numpy.maximum(0, 1 - fatigue)
+            return self.satisfaction(world_model)
         raise NotImplementedError()
 
+class CompiledGoals:
+    # A mind's goals with their subjects resolved to entity ids, indexed by the (attribute, entity id)
+    # each depends on. Totals are cached in each world they are evaluated in, and a world stepped from
+    # one with a cached total only re-evaluates the goals on entities the step changed.
+    __slots__ = ("goal_set", "goals", "entity_ids", "node_count", "subjects", "targets", "dependents", "dependencies")
+
+    def __init__(self, goals, world_model):
+        self.goal_set = frozenset(goals)
+        self.goals = tuple(goals)  # In the mind's iteration order, so a full evaluation sums as before
+        self.entity_ids = world_model.entity_ids
+        self.node_count = len(world_model.graph.locations)
+        self.subjects = [world_model.entity_ids[goal.subject] for goal in self.goals]
+        # The nodes where each "is in" goal holds, and None for the other goals
+        self.targets = [world_model.graph.nodes_named(goal.object.name) if goal.relation == "is in" else None
+                        for goal in self.goals]
+        self.dependents = {}
+        for index, (goal, entity_id) in enumerate(zip(self.goals, self.subjects)):
+            self.dependents.setdefault((goal.dependency(), entity_id), []).append(index)
+        self.dependencies = sorted(self.dependents)
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def optimistic_bounds(self, world_model):
+        # For each goal, the fewest steps before it could be satisfied and the most it is worth then.
+        # Nothing lowers an attribute, so other goals are worth at most what they are worth now.
+        bounds = []
+        for goal, entity_id, targets in zip(self.goals, self.subjects, self.targets):
+            if targets is None:
+                bounds.append((0, goal.evaluate(world_model, entity_id)))
+            else:
+                bounds.append((world_model.graph.distance_to_any(world_model.locations[entity_id], targets), 1))
+        return bounds
+
+    def state_key(self, world_model, actor_id):
+        # Everything the rewards of a rollout by the actor depend on: the values the goals read, and the
+        # actor's location and fatigue, which are all its actions change. Cheap whatever the world's size.
+        return (world_model.locations[actor_id], world_model.fatigue[actor_id],
+                tuple([world_model.value_of(entity_id, attribute) for attribute, entity_id in self.dependencies]))
+
+    def satisfaction(self, world_model):
+        totals = world_model.totals
+        cached = totals.get(self)
+        if cached is not None:
+            return cached[1]
+        previous = world_model.inherited.get(self) if world_model.inherited is not None else None
+        if previous is None or world_model.changed is None:
+            values = [goal.evaluate(world_model, entity_id) for goal, entity_id in zip(self.goals, self.subjects)]
+            totals[self] = (values, sum(values))
+            return totals[self][1]
+        values, total = previous
+        dirty = [index for attribute, entity_ids in world_model.changed.items() for entity_id in entity_ids
+                 for index in self.dependents.get((attribute, entity_id), ())]
+        if dirty:
+            values = list(values)
+            for index in dirty:
+                values[index] = self.goals[index].evaluate(world_model, self.subjects[index])
+            # Summed afresh in goal order rather than adjusted by the difference, so totals are exactly
+            # those of a full evaluation and of batched rollouts, down to the last bit
+            total = sum(values)
+        totals[self] = (values, total)
+        return total
+
 class Action:
+    __slots__ = ("summary", "present_tense")
+
     def __init__(self, summary, present_tense):
         self.summary = summary
         self.present_tense = present_tense
@@ -169,6 +775,9 @@ class Action:
     def __repr__(self):
         return self.summary
 
+    def __deepcopy__(self, memo):
+        return self
+
 class Statement:
     def __init__(self, speaker, words):
         self.speaker = speaker
@@ -177,27 +786,28 @@ class Statement:
     def __str__(self):
         return str(self.speaker) + ": " + self.words
 
-world = World()
+if __name__ == "__main__":
+    world = World()
 
-antioch = Location("in Antioch")
-south_of_antioch = Location("in the desert, south of Antioch")
-south_of_antioch.north = antioch
+    antioch = Location("in Antioch")
+    south_of_antioch = Location("in the desert, south of Antioch")
+    world.graph.connect(south_of_antioch, "north", antioch)
 
-alice = Body(Mind("Alice"))
-alice.mind.goals.add(Goal(str(alice), "is in", antioch))
-alice.mind.goals.add(Goal(str(alice), "has low", "fatigue"))
-alice.mind.possible_actions.add(Action("wait", "waits"))
-alice.mind.possible_actions.add(Action("go north", "goes north"))
-alice.mind.possible_actions.add(Action("go east", "goes east"))
-alice.mind.possible_actions.add(Action("go west", "goes west"))
-alice.mind.possible_actions.add(Action("go south", "goes south"))
+    alice = Body(Mind("Alice"))
+    alice.mind.goals.add(Goal(str(alice), "is in", antioch))
+    alice.mind.goals.add(Goal(str(alice), "has low", "fatigue"))
+    alice.mind.possible_actions.add(Action("wait", "waits"))
+    alice.mind.possible_actions.add(Action("go north", "goes north"))
+    alice.mind.possible_actions.add(Action("go east", "goes east"))
+    alice.mind.possible_actions.add(Action("go west", "goes west"))
+    alice.mind.possible_actions.add(Action("go south", "goes south"))
 
-world.insert_entity(alice, south_of_antioch)
+    world.insert_entity(alice, south_of_antioch)
 
-alice.mind.world_model = deepcopy(world)  # Give Alice all the knowledge
+    alice.mind.world_model = deepcopy(world)  # Give Alice all the knowledge
 
-while True:
-    action = alice.act(world)
-    print(alice, "({})".format(world.location_of(str(alice))), action.present_tense)
-    world = world.step({str(alice): action})
-    alice = world.get_entity(str(alice))
+    while True:
+        actions = world.collect_actions()
+        for entity, node, action in zip(world.entities, world.locations, actions):
+            print(entity, "({})".format(world.graph.locations[node]), action.present_tense)
+        world = world.apply(actions)
@@ -0,0 +1,253 @@
+from typing import Any, Callable, Dict, Iterator, Mapping, Optional, Tuple
+import mmap
+import os
+import struct
+
+# A versioned binary archive of records, each under a string key, that can be opened without
+# reading what it holds. Snapshots of sessions and worlds and compiled content bundles are archives.
+#
+#   header     magic, format version, kind of record
+#   records    one after another, each encoded with varints that refer to the tables below
+#   strings    every distinct string in the archive once, behind a table of offsets
+#   sequences  every distinct sequence of strings once, behind a table of offsets
+#   index      each record's key (a string id), offset and length
+#   footer     where the tables and index start, and the record count
+#
+# Opening an archive maps the file and reads only the index. Strings, sequences and records are
+# decoded when they are first needed.
+
+MAGIC = b"ENDLSNAP"
+VERSION = 2
+
+HEADER = struct.Struct("<8sHH")  # Magic, version, kind
+FOOTER = struct.Struct("<QQQI")  # Strings offset, sequences offset, index offset, record count
+COUNT = struct.Struct("<I")
+DOUBLE = struct.Struct("<d")
+
+class ArchiveError(Exception):
+    pass
+
+# # # ENCODING # # #
+
+class Encoder:
+    # Writes one record, interning its strings into tables shared by the whole archive
+    def __init__(self, strings: Dict[str, int], sequences: Dict[Tuple[Optional[str], ...], int]) -> None:
+        self.strings = strings
+        self.sequences = sequences
+        self.buffer = bytearray()
+
+    def uint(self, value: int) -> None:
+        while value >= 0x80:
+            self.buffer.append((value & 0x7f) | 0x80)
+            value >>= 7
+        self.buffer.append(value)
+
+    def signed(self, value: int) -> None:
+        self.uint(value * 2 if value >= 0 else -value * 2 - 1)
+
+    def double(self, value: float) -> None:
+        self.buffer += DOUBLE.pack(value)
+
+    def intern(self, value: str) -> int:
+        if value not in self.strings:
+            self.strings[value] = len(self.strings)
+        return self.strings[value]
+
+    def text(self, value: str) -> None:
+        self.uint(self.intern(value))
+
+    def optional_text(self, value: Optional[str]) -> None:
+        self.uint(0 if value is None else 1)
+        if value is not None:
+            self.text(value)
+
+    def sequence(self, values: Tuple[Optional[str], ...]) -> None:
+        # Sequences like a mind's lines of dialogue are shared by most records, so they are interned too
+        if values not in self.sequences:
+            for value in values:
+                if value is not None:
+                    self.intern(value)
+            self.sequences[values] = len(self.sequences)
+        self.uint(self.sequences[values])
+
+class Decoder:
+    def __init__(self, data: Any, position: int, archive: 'Archive') -> None:
+        self.data = data
+        self.position = position
+        self.archive = archive
+
+    def uint(self) -> int:
+        result = 0
+        shift = 0
+        while True:
+            byte = self.data[self.position]
+            self.position += 1
+            result |= (byte & 0x7f) << shift
+            if byte < 0x80:
+                return result
+            shift += 7
+
+    def signed(self) -> int:
+        value = self.uint()
+        return value // 2 if value % 2 == 0 else -(value + 1) // 2
+
+    def double(self) -> float:
+        value, = DOUBLE.unpack_from(self.data, self.position)
+        self.position += DOUBLE.size
+        return float(value)
+
+    def text(self) -> str:
+        return self.archive.string(self.uint())
+
+    def optional_text(self) -> Optional[str]:
+        return self.text() if self.uint() else None
+
+    def sequence(self) -> Tuple[Optional[str], ...]:
+        return self.archive.sequence(self.uint())
+
+    def texts(self) -> Tuple[str, ...]:
+        # A sequence known to hold no None
+        return tuple(text for text in self.sequence() if text is not None)
+
+# # # ARCHIVES # # #
+
+def offset_table(blobs: Any) -> bytearray:
+    # A count, then where each blob starts and where the last one ends, then the blobs
+    table = bytearray(COUNT.pack(len(blobs)))
+    position = 0
+    for blob in blobs:
+        table += COUNT.pack(position)
+        position += len(blob)
+    table += COUNT.pack(position)
+    for blob in blobs:
+        table += blob
+    return table
+
+def write_archive(path: str, kind: int, records: Mapping[str, Any], encode: Callable[[Encoder, Any], None]) -> None:
+    # Written to a temporary file and moved into place, so a crash never leaves half an archive
+    strings: Dict[str, int] = {}
+    sequences: Dict[Tuple[Optional[str], ...], int] = {}
+    index = Encoder(strings, sequences)
+    temporary = "{}.{}.tmp".format(path, os.getpid())
+    with open(temporary, "wb") as f:
+        f.write(HEADER.pack(MAGIC, VERSION, kind))
+        offset = HEADER.size
+        for key, record in records.items():
+            encoder = Encoder(strings, sequences)
+            encode(encoder, record)
+            f.write(encoder.buffer)
+            index.text(key)
+            index.uint(offset)
+            index.uint(len(encoder.buffer))
+            offset += len(encoder.buffer)
+        encoded_sequences = []
+        for sequence in sequences:  # In id order
+            items = Encoder(strings, sequences)
+            for value in sequence:
+                items.uint(0 if value is None else strings[value] + 1)
+            encoded_sequences.append(items.buffer)
+        string_table = offset_table([string.encode("utf-8") for string in strings])
+        sequence_table = offset_table(encoded_sequences)
+        f.write(string_table)
+        f.write(sequence_table)
+        f.write(index.buffer)
+        f.write(FOOTER.pack(offset, offset + len(string_table), offset + len(string_table) + len(sequence_table), len(records)))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temporary, path)
+    sync_directory(os.path.dirname(os.path.abspath(path)))
+
+def sync_directory(path: str) -> None:
+    # A rename, new file or removal only survives a crash once its directory is synced too
+    fd = os.open(path, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+class Archive:
+    # A read-only, memory-mapped archive. Records are decoded on every access; strings and
+    # sequences once, when first used.
+    def __init__(self, path: str, kind: int, decode: Callable[[Decoder], Any]) -> None:
+        self.decode = decode
+        with open(path, "rb") as f:
+            # An empty file can't be mapped at all, so check the size first
+            if os.fstat(f.fileno()).st_size < HEADER.size + FOOTER.size:
+                raise ArchiveError("{} is too short to be an archive".format(path))
+            self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.read_index(path, kind)
+        except BaseException:
+            self.data.close()
+            raise
+
+    def read_index(self, path: str, kind: int) -> None:
+        magic, version, found_kind = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC:
+            raise ArchiveError("{} is not an archive".format(path))
+        if version != VERSION:
+            raise ArchiveError("{} is version {} but only version {} can be read".format(path, version, VERSION))
+        if found_kind != kind:
+            raise ArchiveError("{} holds kind {} records, not kind {}".format(path, found_kind, kind))
+        footer = len(self.data) - FOOTER.size
+        self.strings_offset, self.sequences_offset, index_offset, count = FOOTER.unpack_from(self.data, footer)
+        if not HEADER.size <= self.strings_offset <= self.sequences_offset <= index_offset <= footer:
+            raise ArchiveError("{} is truncated or corrupt".format(path))
+        self.strings: Dict[int, str] = {}
+        self.sequences: Dict[int, Tuple[Optional[str], ...]] = {}
+
+        index = Decoder(self.data, index_offset, self)
+        self.index: Dict[str, Tuple[int, int]] = {}
+        try:
+            for _ in range(count):
+                key = index.text()
+                offset = index.uint()
+                self.index[key] = (offset, index.uint())
+        except (IndexError, UnicodeDecodeError, struct.error):
+            raise ArchiveError("{} is truncated or corrupt".format(path))
+
+    def blob(self, table: int, position: int) -> Tuple[int, int]:
+        # Where a blob in an offset table starts and ends
+        count, = COUNT.unpack_from(self.data, table)
+        start, end = struct.unpack_from("<II", self.data, table + COUNT.size * (position + 1))
+        data = table + COUNT.size * (count + 2)
+        return data + start, data + end
+
+    def string(self, position: int) -> str:
+        if position not in self.strings:
+            start, end = self.blob(self.strings_offset, position)
+            self.strings[position] = self.data[start:end].decode("utf-8")
+        return self.strings[position]
+
+    def sequence(self, position: int) -> Tuple[Optional[str], ...]:
+        if position not in self.sequences:
+            start, end = self.blob(self.sequences_offset, position)
+            items = Decoder(self.data, start, self)
+            values = []
+            while items.position < end:
+                value = items.uint()
+                values.append(self.string(value - 1) if value else None)
+            self.sequences[position] = tuple(values)
+        return self.sequences[position]
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __contains__(self, key: str) -> bool:
+        return key in self.index
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def __getitem__(self, key: str) -> Any:
+        offset, _ = self.index[key]
+        return self.decode(Decoder(self.data, offset, self))
+
+    def close(self) -> None:
+        self.data.close()
+
+    def __enter__(self) -> 'Archive':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
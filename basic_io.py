@@ -1,4 +1,8 @@
-from typing import Callable
+from typing import BinaryIO, Callable, List, Optional, TextIO, Tuple, Union
+import mmap
+import os
+import select
+import sys
 
 # TYPES
 
@@ -17,15 +21,167 @@ def get_input_from_stdin() -> str:
 def print_to_stdout(text: str) -> None:
     print(text)
 
+def parse_int_choice(text: str, range_: range) -> Tuple[Optional[int], str]:
+    # The choice, or None and what to tell the player
+    try:
+        result = int(text)
+    except ValueError:  # type: ignore
+        return None, "That is not a valid integer."
+    if result not in range_:
+        return None, "That choice is not valid. (Valid choices are {})".format(','.join([str(x) for x in range_]))
+    return result, ""
+
 def get_int_input(range_: range, get_input: Input, output: Output) -> int:
     result = None
     while result is None:
-        try:
-            result = int(get_input())
-        except ValueError:  # type: ignore
-            output("That is not a valid integer.")
-            continue
-        if result not in range_:
-            output("That choice is not valid. (Valid choices are {})".format(','.join([str(x) for x in range_])))
-            result = None
+        result, complaint = parse_int_choice(get_input(), range_)
+        if result is None:
+            output(complaint)
     return result
+
+# TRANSCRIPTS
+
+# A transcript is the player's commands, one per line, in UTF-8. Nothing else is stored: replaying
+# it through the same game reproduces everything the game said.
+
+class TranscriptInput:
+    # An Input that plays a transcript back lazily, a line at a time, from the file or from a
+    # memory map of it. Like stdin, it raises EOFError when the transcript runs out.
+    def __init__(self, path: str, use_mmap: bool=False, echo: Optional[Output]=None) -> None:
+        self.file = open(path, "rb")
+        self.source: Union[BinaryIO, mmap.mmap] = self.file
+        if use_mmap and os.fstat(self.file.fileno()).st_size > 0:
+            self.source = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.echo = echo
+        self.commands_read = 0
+
+    def __call__(self) -> str:
+        result = ""
+        while result == "":
+            line = self.source.readline()
+            if not line:
+                raise EOFError("End of transcript")
+            result = line.rstrip(b"\r\n").decode("utf-8")
+        self.commands_read += 1
+        if self.echo is not None:
+            self.echo("> " + result)
+        return result
+
+    def close(self) -> None:
+        if self.source is not self.file:
+            self.source.close()
+        self.file.close()
+
+    def __enter__(self) -> 'TranscriptInput':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+class TranscriptRecorder:
+    # Wraps an Input, appending every command it returns to a transcript
+    def __init__(self, get_input: Input, path: str) -> None:
+        self.get_input = get_input
+        self.file = open(path, "ab")
+
+    def __call__(self) -> str:
+        result = self.get_input()
+        if "\n" in result or "\r" in result:
+            raise ValueError("Commands in a transcript can't span lines: {!r}".format(result))
+        self.file.write(result.encode("utf-8") + b"\n")
+        return result
+
+    def close(self) -> None:
+        self.file.close()
+
+    def __enter__(self) -> 'TranscriptRecorder':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
+
+# BUFFERED OUTPUT
+
+class BufferedOutput:
+    # An Output that writes its lines in one go: when the player is asked for input (through an
+    # Input wrapped by wrap_input), when threshold characters are waiting, or when flushed.
+    def __init__(self, stream: Optional[TextIO]=None, threshold: int=8192) -> None:
+        self.stream = stream
+        self.threshold = threshold
+        self.pending: List[str] = []
+        self.size = 0
+
+    def __call__(self, text: str) -> None:
+        line = str(text) + "\n"
+        self.pending.append(line)
+        self.size += len(line)
+        if self.size >= self.threshold:
+            self.flush()
+
+    def flush(self) -> None:
+        stream = self.stream if self.stream is not None else sys.stdout
+        if self.pending:
+            stream.write("".join(self.pending))
+            self.pending = []
+            self.size = 0
+        stream.flush()
+
+    def wrap_input(self, get_input: Input) -> Input:
+        def flushed_input() -> str:
+            self.flush()
+            return get_input()
+        return flushed_input
+
+    def __enter__(self) -> 'BufferedOutput':
+        return self
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.flush()
+
+class NonBlockingOutput(BufferedOutput):
+    # For sockets and pipes. Writing never blocks: whatever the file descriptor won't take yet stays
+    # pending for the next write. Only asking for input waits, until the player has seen everything.
+    # The file descriptor belongs to the caller, so closing puts back how it blocked but leaves it open.
+    def __init__(self, fd: int, threshold: int=8192, encoding: str="utf-8") -> None:
+        super().__init__(None, threshold)
+        self.fd = fd
+        self.encoding = encoding
+        self.unsent = bytearray()
+        self.was_blocking: Optional[bool] = os.get_blocking(fd)
+        os.set_blocking(fd, False)
+
+    def flush(self) -> None:
+        if self.pending:
+            self.unsent += "".join(self.pending).encode(self.encoding)
+            self.pending = []
+            self.size = 0
+        while self.unsent:
+            try:
+                written = os.write(self.fd, self.unsent)
+            except BlockingIOError:
+                return
+            del self.unsent[:written]
+
+    def drain(self) -> None:
+        self.flush()
+        while self.unsent:
+            select.select([], [self.fd], [])
+            self.flush()
+
+    def wrap_input(self, get_input: Input) -> Input:
+        def drained_input() -> str:
+            self.drain()
+            return get_input()
+        return drained_input
+
+    def close(self) -> None:
+        if self.was_blocking is None:
+            return
+        try:
+            self.drain()
+        finally:
+            os.set_blocking(self.fd, self.was_blocking)
+            self.was_blocking = None
+
+    def __exit__(self, *exc_info: object) -> None:
+        self.close()
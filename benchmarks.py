@@ -0,0 +1,240 @@
+from typing import Any, Callable, Dict, List, Tuple
+import argparse
+import contextlib
+import gc
+import io as stdio
+import json
+import platform
+import sys
+import time
+import tracemalloc
+from copy import deepcopy
+
+import main
+import alice_in_antioch as antioch
+
+# Each benchmark is a setup function returning a zero-argument operation and how many units of work
+# (turns, decisions, steps) one call of it does. Calls are timed one at a time so percentiles can be
+# reported, and memory is traced on a separate call so tracing doesn't inflate the timings.
+
+Benchmark = Callable[[], Tuple[Callable[[], Any], int]]
+Results = Dict[str, Dict[str, float]]
+
+SPEECH_STREAMS = {
+    "nonsense": ("hello", "what?", "sit", "tomar", "please", "stop", "run", "go"),
+    "spells": ("shta", "shak", "shta", "shak", "shta", "shak", "shta", "shak"),
+    "tutorial": ("hello", "shta", "ready", "shak", "shak", "shta", "what?", "shta"),
+}
+
+def percentile(ordered: List[float], fraction: float) -> float:
+    # Nearest rank, so every reported value is one that was actually measured
+    index = min(len(ordered) - 1, max(0, int(round(fraction * len(ordered) + 0.5)) - 1))
+    return ordered[index]
+
+def summarize(timings: List[float], units: int, peak_bytes: int) -> Dict[str, float]:
+    ordered = sorted(timings)
+    total = sum(ordered)
+    return {
+        "calls": len(ordered),
+        "units_per_call": units,
+        "mean_s": total / len(ordered),
+        "min_s": ordered[0],
+        "p50_s": percentile(ordered, 0.5),
+        "p90_s": percentile(ordered, 0.9),
+        "p99_s": percentile(ordered, 0.99),
+        "max_s": ordered[-1],
+        "units_per_s": units * len(ordered) / total if total > 0 else float("inf"),
+        "peak_bytes": peak_bytes,
+    }
+
+def measure(benchmark: Benchmark, repeat: int, warmup: int=1) -> Dict[str, float]:
+    operation, units = benchmark()
+    for _ in range(warmup):
+        operation()
+    tracemalloc.start()
+    operation()
+    _, peak_bytes = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings = []
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            operation()
+            timings.append(time.perf_counter() - start)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return summarize(timings, units, peak_bytes)
+
+# # # TOMAR # # #
+
+def entity_turns(speeches: Tuple[str, ...]) -> Benchmark:
+    def setup() -> Tuple[Callable[[], Any], int]:
+        def operation() -> None:
+            tomar = main.TOMAR
+            for speech in speeches:
+                tomar, _, _ = main.entity_turn(tomar, main.STARTING_LABORATORY, speech)
+        return operation, len(speeches)
+    return setup
+
+def spell_attempts(speeches: Tuple[str, ...]) -> Benchmark:
+    def setup() -> Tuple[Callable[[], Any], int]:
+        def operation() -> None:
+            tomar = main.TOMAR
+            for speech in speeches:
+                tomar, _ = main.attempt_spell(speech, tomar, main.STARTING_LABORATORY)
+        return operation, len(speeches)
+    return setup
+
+# # # ALICE # # #
+
+EXTRA_ACTIONS = ("sing", "dance", "pray", "rest", "read", "cook", "shout", "sleep")
+
+def alice_world(actions: int, entities: int, width: int=4) -> Tuple[Any, Any]:
+    # A width x width grid of places with Antioch in one corner and Alice in the other, sharing the
+    # world with idle bystanders. Alice knows the first `actions` of the moves and extra actions.
+    world = antioch.World()
+    places = [[antioch.Location("in the desert ({}, {})".format(x, y)) for x in range(width)] for y in range(width)]
+    places[0][0] = antioch.Location("in Antioch")
+    for y in range(width):
+        for x in range(width):
+            if x + 1 < width:
+                world.graph.connect(places[y][x], "east", places[y][x + 1])
+            if y + 1 < width:
+                world.graph.connect(places[y + 1][x], "north", places[y][x])
+
+    alice = antioch.Body(antioch.Mind("Alice"))
+    alice.mind.goals.add(antioch.Goal(str(alice), "is in", places[0][0]))
+    alice.mind.goals.add(antioch.Goal(str(alice), "has low", "fatigue"))
+    names = ["wait"] + sorted(antioch.LocationGraph.moves) + list(EXTRA_ACTIONS)
+    for name in names[:actions]:
+        alice.mind.possible_actions.add(antioch.Action(name, name + "s"))
+    world.insert_entity(alice, places[width - 1][width - 1])
+    for i in range(entities - 1):
+        world.insert_entity(antioch.Body(antioch.Mind("Bystander {}".format(i))), places[i % width][(i // width) % width])
+    alice.mind.world_model = deepcopy(world)
+    return world, alice
+
+def alice_mind(summaries: Tuple[str, ...]=(), city_to_the_north: bool=False,
+               mind_type: Callable[[str], Any]=antioch.Mind) -> Any:
+    # Alice alone in her own world model, wanting to stay rested and, if there is a city north of
+    # where she is, to be in it. She knows an action for each summary.
+    mind = mind_type("Alice")
+    if city_to_the_north:
+        city = antioch.Location("in Antioch")
+        mind.world_model.graph.connect(mind.world_model.location_of("Alice"), "north", city)
+        mind.goals.add(antioch.Goal("Alice", "is in", city))
+    mind.goals.add(antioch.Goal("Alice", "has low", "fatigue"))
+    for summary in summaries:
+        mind.possible_actions.add(antioch.Action(summary, summary))
+    return mind
+
+def decisions(breadth: int, depth: int, actions: int, entities: int) -> Benchmark:
+    def setup() -> Tuple[Callable[[], Any], int]:
+        world, alice = alice_world(actions, entities)
+        alice.mind.search_breadth = breadth
+        alice.mind.search_depth = depth
+
+        def operation() -> None:
+            alice.mind.policy = None
+            alice.mind.search = None
+            with contextlib.redirect_stdout(stdio.StringIO()):
+                alice.act(world)
+        return operation, 1
+    return setup
+
+def world_steps(entities: int, steps: int=10) -> Benchmark:
+    def setup() -> Tuple[Callable[[], Any], int]:
+        world, _ = alice_world(1, entities)
+        moves = [antioch.Action(name, name + "s") for name in sorted(antioch.LocationGraph.moves)]
+        entity_actions = {name: moves[entity_id % len(moves)] for name, entity_id in world.entity_ids.items()}
+
+        def operation() -> None:
+            stepped = world
+            for _ in range(steps):
+                stepped = stepped.step(entity_actions)
+        return operation, steps
+    return setup
+
+def world_building(entities: int) -> Benchmark:
+    # Mostly of interest for its memory peak: every entity's record, mind and world model
+    def setup() -> Tuple[Callable[[], Any], int]:
+        return (lambda: alice_world(5, entities)), entities
+    return setup
+
+def world_copies(entities: int) -> Benchmark:
+    def setup() -> Tuple[Callable[[], Any], int]:
+        world, _ = alice_world(5, entities)
+        return (lambda: deepcopy(world)), 1
+    return setup
+
+def suite(quick: bool=False) -> Dict[str, Benchmark]:
+    benchmarks: Dict[str, Benchmark] = {}
+    for name, speeches in SPEECH_STREAMS.items():
+        benchmarks["entity_turn/" + name] = entity_turns(speeches)
+        benchmarks["attempt_spell/" + name] = spell_attempts(speeches)
+    breadths = (10, 100) if quick else (10, 100, 1000)
+    depths = (3, 10) if quick else (3, 10, 20)
+    for breadth in breadths:
+        for depth in depths:
+            benchmarks["mind_act/breadth={},depth={},actions=5,entities=1".format(breadth, depth)] = decisions(breadth, depth, 5, 1)
+    for actions in ((2, 13) if quick else (2, 5, 9, 13)):
+        benchmarks["mind_act/breadth=1000,depth=10,actions={},entities=1".format(actions)] = decisions(1000, 10, actions, 1)
+    for entities in ((1, 100) if quick else (1, 10, 100, 1000)):
+        benchmarks["mind_act/breadth=1000,depth=10,actions=5,entities={}".format(entities)] = decisions(1000, 10, 5, entities)
+    for entities in ((1, 100) if quick else (1, 10, 100, 1000, 10000)):
+        benchmarks["world_step/entities={}".format(entities)] = world_steps(entities)
+    for entities in ((1, 100) if quick else (1, 100, 1000)):
+        benchmarks["world_memory/build,entities={}".format(entities)] = world_building(entities)
+        benchmarks["world_memory/deepcopy,entities={}".format(entities)] = world_copies(entities)
+    return benchmarks
+
+def run(benchmarks: Dict[str, Benchmark], repeat: int, report: Callable[[str], None]=print) -> Dict[str, Any]:
+    results: Results = {}
+    for name, benchmark in benchmarks.items():
+        results[name] = measure(benchmark, repeat)
+        report("{:<60} {:>12.1f} units/s  p50 {:.6f}s  p99 {:.6f}s  peak {} B".format(
+            name, results[name]["units_per_s"], results[name]["p50_s"], results[name]["p99_s"], int(results[name]["peak_bytes"])))
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeat": repeat,
+        "results": results,
+    }
+
+def compare(baseline: Results, current: Results, tolerance: float) -> List[str]:
+    # A benchmark regresses when its median time or its memory peak grows by more than tolerance
+    regressions = []
+    for name in sorted(set(baseline) & set(current)):
+        for metric in ("p50_s", "peak_bytes"):
+            before = baseline[name][metric]
+            after = current[name][metric]
+            if before > 0 and (after - before) / before > tolerance:
+                regressions.append("{} {}: {:.6g} -> {:.6g} ({:+.1%})".format(name, metric, before, after, (after - before) / before))
+    return regressions
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark Tomar's turns, Alice's planning and World.step.")
+    parser.add_argument("--repeat", type=int, default=20, help="timed calls per benchmark")
+    parser.add_argument("--quick", action="store_true", help="run a smaller grid of planner and world sizes")
+    parser.add_argument("--filter", default="", help="only run benchmarks whose name contains this")
+    parser.add_argument("--output", help="write the JSON results to this file instead of stdout")
+    parser.add_argument("--compare", help="JSON results of an earlier run to check for regressions against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="fractional slowdown allowed by --compare")
+    args = parser.parse_args()
+    benchmarks = {name: benchmark for name, benchmark in suite(args.quick).items() if args.filter in name}
+    document = run(benchmarks, args.repeat, report=lambda line: print(line, file=sys.stderr))
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(document, f, indent=2, sort_keys=True)
+    else:
+        json.dump(document, sys.stdout, indent=2, sort_keys=True)
+        print()
+    if args.compare:
+        with open(args.compare) as f:
+            regressions = compare(json.load(f)["results"], document["results"], args.tolerance)
+        for regression in regressions:
+            print("REGRESSION " + regression, file=sys.stderr)
+        sys.exit(1 if regressions else 0)
@@ -0,0 +1,421 @@
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional, Tuple
+import argparse
+import json
+import os
+import sys
+import tempfile
+import zlib
+
+from archives import Archive, ArchiveError, Decoder, Encoder, write_archive
+
+# Characters, places and what characters do are written as JSON content and compiled to a bundle:
+# an archive in which every string is stored once and control systems, strategy nodes, predicates
+# and responses refer to each other by integer id. Nothing is read from a bundle until a character
+# or place is asked for, so starting up costs the same however much content there is.
+#
+# Content is an object with these members, each an object keyed by stable name:
+#
+#   locations        name, perception, position, nature (a list) and foci (a list)
+#   control_systems  name, is_satisfied (a predicate), init_action (an action summary or null),
+#                    confusion_details (suggestions and explanation, or null), say_on_progress
+#                    (a response) and say_on_return_without_progress (a response or null)
+#   strategies       strategies that can be referred to by name from other strategies and npcs
+#   npcs             strategy, statements_of_confusion and statements_of_impatience
+#
+# A strategy is the name of one, or an object with the control system that is active and either
+# where to go onward (a strategy or null) or a fork: a list of {"if": predicate, "then": strategy},
+# the first of which that holds is taken, and a fallback strategy for when none do.
+#
+# A predicate is true, false, {"believes": belief} (with "holds": false for the opposite),
+# {"impatience_above": n}, {"confusion_above": n}, or {"any": [...]} or {"all": [...]} of others.
+# A response is {"say": text} or {"call": name} of a response function registered by the game.
+
+CONTENT = 3  # Archive kind
+
+class ContentError(Exception):
+    pass
+
+# # # SPECS # # #
+
+class PredicateSpec(NamedTuple):
+    kind: str  # always, believes, impatience_above, confusion_above, any or all
+    belief: Optional[str]
+    holds: bool
+    threshold: int
+    operands: Tuple[int, ...]  # Predicate ids
+
+class ResponseSpec(NamedTuple):
+    kind: str  # say or call
+    text: str  # What to say, or the name of the function to call
+
+class ControlSystemSpec(NamedTuple):
+    key: str
+    name: str
+    is_satisfied: int  # Predicate id
+    init_action: Optional[str]
+    confusion_suggestions: Optional[Tuple[str, ...]]
+    confusion_explanation: Optional[str]
+    say_on_progress: int  # Response id
+    say_on_return_without_progress: Optional[int]  # Response id
+
+class StrategyNodeSpec(NamedTuple):
+    control_system: int  # Control system id
+    transitions: Tuple[Tuple[Optional[int], Optional[int]], ...]  # Predicate id (None always holds), node id (None ends)
+
+class NpcSpec(NamedTuple):
+    key: str
+    strategy: int  # Node id
+    statements_of_confusion: Tuple[Optional[str], ...]
+    statements_of_impatience: Tuple[Optional[str], ...]
+
+class LocationSpec(NamedTuple):
+    key: str
+    name: str
+    perception: str
+    position: str
+    nature: Tuple[str, ...]
+    foci: Tuple[str, ...]
+
+class SourceSpec(NamedTuple):
+    size: int
+    mtime_ns: int
+
+# # # COMPILER # # #
+
+def expect(condition: bool, where: str, problem: str) -> None:
+    if not condition:
+        raise ContentError("{}: {}".format(where, problem))
+
+class Compiler:
+    # Identical predicates and responses are compiled once and shared
+    def __init__(self, source: Dict[str, Any]) -> None:
+        self.source = source
+        self.predicates: Dict[PredicateSpec, int] = {}
+        self.responses: Dict[ResponseSpec, int] = {}
+        self.control_system_ids = {key: i for i, key in enumerate(source.get("control_systems", {}))}
+        self.nodes: List[Optional[StrategyNodeSpec]] = []
+        self.named_strategies: Dict[str, int] = {}
+        self.node_ids: Dict[StrategyNodeSpec, int] = {}
+
+    def predicate(self, source: Any, where: str) -> int:
+        if isinstance(source, bool):
+            spec = PredicateSpec("always", None, source, 0, ())
+        else:
+            expect(isinstance(source, dict) and len(set(source) - {"holds"}) == 1, where, "not a predicate")
+            if "believes" in source:
+                expect(isinstance(source["believes"], str), where, "beliefs are strings")
+                expect(isinstance(source.get("holds", True), bool), where + ".holds", "holds is true or false")
+                spec = PredicateSpec("believes", source["believes"], source.get("holds", True), 0, ())
+            elif "holds" in source:
+                raise ContentError("{}.holds: only beliefs can be negated".format(where))
+            elif "impatience_above" in source or "confusion_above" in source:
+                kind, = source
+                expect(isinstance(source[kind], int), where, "thresholds are integers")
+                spec = PredicateSpec(kind, None, True, source[kind], ())
+            elif "any" in source or "all" in source:
+                kind, = source
+                expect(isinstance(source[kind], list), where, "{} takes a list of predicates".format(kind))
+                operands = tuple(self.predicate(operand, "{}.{}[{}]".format(where, kind, i)) for i, operand in enumerate(source[kind]))
+                spec = PredicateSpec(kind, None, True, 0, operands)
+            else:
+                raise ContentError("{}: unknown predicate {}".format(where, json.dumps(source)))
+        if spec not in self.predicates:
+            self.predicates[spec] = len(self.predicates)
+        return self.predicates[spec]
+
+    def response(self, source: Any, where: str) -> int:
+        expect(isinstance(source, dict) and len(source) == 1 and set(source) <= {"say", "call"}, where, "not a response")
+        kind, = source
+        expect(isinstance(source[kind], str), where, "responses say or call a string")
+        spec = ResponseSpec(kind, source[kind])
+        if spec not in self.responses:
+            self.responses[spec] = len(self.responses)
+        return self.responses[spec]
+
+    def strategy(self, source: Any, where: str) -> int:
+        # Named strategies get their node before their bodies are compiled, so they can lead back to
+        # themselves. Other strategies are compiled bottom up and shared with identical ones.
+        if isinstance(source, str):
+            if source not in self.named_strategies:
+                expect(source in self.source.get("strategies", {}), where, "no strategy named {}".format(source))
+                self.named_strategies[source] = len(self.nodes)
+                self.nodes.append(None)
+                self.nodes[self.named_strategies[source]] = self.strategy_node(self.source["strategies"][source],
+                                                                               "strategies." + source)
+            return self.named_strategies[source]
+        spec = self.strategy_node(source, where)
+        if spec not in self.node_ids:
+            self.node_ids[spec] = len(self.nodes)
+            self.nodes.append(spec)
+        return self.node_ids[spec]
+
+    def strategy_node(self, source: Any, where: str) -> StrategyNodeSpec:
+        expect(isinstance(source, dict) and "active" in source, where, "not a strategy")
+        expect(source["active"] in self.control_system_ids, where, "no control system named {}".format(source["active"]))
+        transitions: List[Tuple[Optional[int], Optional[int]]]
+        if "fork" in source:
+            transitions = [(self.predicate(option.get("if"), "{}.fork[{}].if".format(where, i)),
+                            self.strategy(option.get("then"), "{}.fork[{}].then".format(where, i)))
+                           for i, option in enumerate(source["fork"])]
+            transitions.append((None, self.strategy(source.get("fallback"), where + ".fallback")))
+        else:
+            onward = source.get("onward")
+            transitions = [(None, self.strategy(onward, where + ".onward") if onward is not None else None)]
+        return StrategyNodeSpec(self.control_system_ids[source["active"]], tuple(transitions))
+
+    def control_system(self, key: str, source: Any) -> ControlSystemSpec:
+        where = "control_systems." + key
+        expect(isinstance(source, dict), where, "not an object")
+        confusion = source.get("confusion_details")
+        if confusion is not None:
+            expect(isinstance(confusion, dict), where + ".confusion_details", "not an object")
+            suggestions = confusion.get("suggestions")
+            expect(isinstance(suggestions, list) and all(isinstance(suggestion, str) for suggestion in suggestions),
+                   where + ".confusion_details.suggestions", "suggestions are a list of strings")
+            expect(isinstance(confusion.get("explanation"), str), where + ".confusion_details.explanation",
+                   "explanations are strings")
+        expect(isinstance(source.get("name", key), str), where + ".name", "names are strings")
+        expect(source.get("init_action") is None or isinstance(source["init_action"], str), where + ".init_action",
+               "actions are strings")
+        return_response = source.get("say_on_return_without_progress")
+        return ControlSystemSpec(
+            key=key,
+            name=source.get("name", key),
+            is_satisfied=self.predicate(source.get("is_satisfied", False), where + ".is_satisfied"),
+            init_action=source.get("init_action"),
+            confusion_suggestions=tuple(confusion["suggestions"]) if confusion else None,
+            confusion_explanation=confusion["explanation"] if confusion else None,
+            say_on_progress=self.response(source.get("say_on_progress"), where + ".say_on_progress"),
+            say_on_return_without_progress=(self.response(return_response, where + ".say_on_return_without_progress")
+                                            if return_response is not None else None),
+        )
+
+    def records(self) -> Dict[str, Any]:
+        records: Dict[str, Any] = {}
+        for key, source in self.source.get("locations", {}).items():
+            where = "locations." + key
+            expect(isinstance(source, dict) and {"name", "perception", "position"} <= set(source), where, "not a location")
+            records["location/" + key] = LocationSpec(key, source["name"], source["perception"], source["position"],
+                                                      tuple(source.get("nature", ())), tuple(source.get("foci", ())))
+        for key, source in self.source.get("control_systems", {}).items():
+            records["control_system/{}".format(self.control_system_ids[key])] = self.control_system(key, source)
+            records["control_system_id/" + key] = self.control_system_ids[key]
+        for key, source in self.source.get("npcs", {}).items():
+            where = "npcs." + key
+            expect(isinstance(source, dict) and "strategy" in source, where, "not an npc")
+            records["npc/" + key] = NpcSpec(key, self.strategy(source["strategy"], where + ".strategy"),
+                                            tuple(source.get("statements_of_confusion", ())),
+                                            tuple(source.get("statements_of_impatience", ())))
+        for key in self.source.get("strategies", {}):  # Even those no npc uses yet
+            records["strategy/" + key] = self.strategy(key, "strategies." + key)
+        for node, spec in enumerate(self.nodes):
+            records["strategy_node/{}".format(node)] = spec
+        for predicate, predicate_id in self.predicates.items():
+            records["predicate/{}".format(predicate_id)] = predicate
+        for response, response_id in self.responses.items():
+            records["response/{}".format(response_id)] = response
+        return records
+
+# # # BUNDLES # # #
+
+RECORD_TYPES = (int, SourceSpec, LocationSpec, ControlSystemSpec, NpcSpec, StrategyNodeSpec, PredicateSpec,
+                ResponseSpec)  # Indexed by type tag
+
+def optional_id(encoder: Encoder, value: Optional[int]) -> None:
+    encoder.uint(0 if value is None else value + 1)
+
+def encode_record(encoder: Encoder, record: Any) -> None:
+    encoder.uint(RECORD_TYPES.index(type(record)))
+    if isinstance(record, SourceSpec):
+        encoder.uint(record.size)
+        encoder.uint(record.mtime_ns)
+    elif isinstance(record, int):
+        encoder.uint(record)
+    elif isinstance(record, LocationSpec):
+        encoder.text(record.key)
+        encoder.sequence((record.name, record.perception, record.position))
+        encoder.sequence(record.nature)
+        encoder.sequence(record.foci)
+    elif isinstance(record, ControlSystemSpec):
+        encoder.text(record.key)
+        encoder.text(record.name)
+        encoder.uint(record.is_satisfied)
+        encoder.optional_text(record.init_action)
+        encoder.uint(0 if record.confusion_suggestions is None else 1)
+        if record.confusion_suggestions is not None and record.confusion_explanation is not None:
+            encoder.sequence(record.confusion_suggestions)
+            encoder.text(record.confusion_explanation)
+        encoder.uint(record.say_on_progress)
+        optional_id(encoder, record.say_on_return_without_progress)
+    elif isinstance(record, NpcSpec):
+        encoder.text(record.key)
+        encoder.uint(record.strategy)
+        encoder.sequence(record.statements_of_confusion)
+        encoder.sequence(record.statements_of_impatience)
+    elif isinstance(record, StrategyNodeSpec):
+        encoder.uint(record.control_system)
+        encoder.uint(len(record.transitions))
+        for predicate, target in record.transitions:
+            optional_id(encoder, predicate)
+            optional_id(encoder, target)
+    elif isinstance(record, PredicateSpec):
+        encoder.text(record.kind)
+        encoder.optional_text(record.belief)
+        encoder.uint(record.holds)
+        encoder.signed(record.threshold)
+        encoder.uint(len(record.operands))
+        for operand in record.operands:
+            encoder.uint(operand)
+    elif isinstance(record, ResponseSpec):
+        encoder.text(record.kind)
+        encoder.text(record.text)
+
+def decode_optional_id(decoder: Decoder) -> Optional[int]:
+    value = decoder.uint()
+    return None if value == 0 else value - 1
+
+def decode_record(decoder: Decoder) -> Any:
+    record_type = RECORD_TYPES[decoder.uint()]
+    if record_type is SourceSpec:
+        size = decoder.uint()
+        return SourceSpec(size, decoder.uint())
+    elif record_type is int:
+        return decoder.uint()
+    elif record_type is LocationSpec:
+        key = decoder.text()
+        name, perception, position = decoder.texts()
+        return LocationSpec(key, name, perception, position, decoder.texts(), decoder.texts())
+    elif record_type is ControlSystemSpec:
+        key = decoder.text()
+        name = decoder.text()
+        is_satisfied = decoder.uint()
+        init_action = decoder.optional_text()
+        suggestions, explanation = (decoder.texts(), decoder.text()) if decoder.uint() else (None, None)
+        say_on_progress = decoder.uint()
+        return ControlSystemSpec(key, name, is_satisfied, init_action, suggestions, explanation, say_on_progress,
+                                 decode_optional_id(decoder))
+    elif record_type is NpcSpec:
+        key = decoder.text()
+        strategy = decoder.uint()
+        statements_of_confusion = decoder.sequence()
+        return NpcSpec(key, strategy, statements_of_confusion, decoder.sequence())
+    elif record_type is StrategyNodeSpec:
+        control_system = decoder.uint()
+        transitions = []
+        for _ in range(decoder.uint()):
+            predicate = decode_optional_id(decoder)
+            transitions.append((predicate, decode_optional_id(decoder)))
+        return StrategyNodeSpec(control_system, tuple(transitions))
+    elif record_type is PredicateSpec:
+        kind = decoder.text()
+        belief = decoder.optional_text()
+        holds = bool(decoder.uint())
+        threshold = decoder.signed()
+        return PredicateSpec(kind, belief, holds, threshold, tuple(decoder.uint() for _ in range(decoder.uint())))
+    else:
+        kind = decoder.text()
+        return ResponseSpec(kind, decoder.text())
+
+def compile_content(source_path: str, bundle_path: str) -> None:
+    with open(source_path, encoding="utf-8") as f:
+        try:
+            source = json.load(f)
+        except ValueError as e:
+            raise ContentError("{}: {}".format(source_path, e))
+    expect(isinstance(source, dict), source_path, "content is an object")
+    records = Compiler(source).records()
+    stat = os.stat(source_path)
+    records["source"] = SourceSpec(stat.st_size, stat.st_mtime_ns)
+    write_archive(bundle_path, CONTENT, records, encode_record)
+
+class Bundle:
+    # Compiled content, read on demand
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.archive = Archive(path, CONTENT, decode_record)
+
+    def source(self) -> SourceSpec:
+        return self.archive["source"]
+
+    def keys(self, kind: str) -> Iterator[str]:
+        prefix = kind + "/"
+        return (key[len(prefix):] for key in self.archive if key.startswith(prefix))
+
+    def location(self, key: str) -> LocationSpec:
+        return self.archive["location/" + key]
+
+    def npc(self, key: str) -> NpcSpec:
+        return self.archive["npc/" + key]
+
+    def control_system_id(self, key: str) -> int:
+        return self.archive["control_system_id/" + key]
+
+    def control_system(self, control_system_id: int) -> ControlSystemSpec:
+        return self.archive["control_system/{}".format(control_system_id)]
+
+    def strategy(self, key: str) -> int:
+        return self.archive["strategy/" + key]
+
+    def strategy_node(self, node: int) -> StrategyNodeSpec:
+        return self.archive["strategy_node/{}".format(node)]
+
+    def predicate(self, predicate_id: int) -> PredicateSpec:
+        return self.archive["predicate/{}".format(predicate_id)]
+
+    def response(self, response_id: int) -> ResponseSpec:
+        return self.archive["response/{}".format(response_id)]
+
+    def close(self) -> None:
+        self.archive.close()
+
+# Bundles are compiled into a cache directory, never next to the content, so a read-only checkout
+# works and nothing is written into the source tree. Where the cache can't be written, one temporary
+# directory is made for the whole process and removed when it exits.
+FALLBACK_CACHE: Optional[tempfile.TemporaryDirectory] = None
+
+def cache_directory() -> str:
+    if "ENDLESS_CACHE_DIR" in os.environ:
+        return os.environ["ENDLESS_CACHE_DIR"]
+    return os.path.join(os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"), "endless")
+
+def cached_bundle_path(source_path: str, directory: str) -> str:
+    # Named for the content and where it lives, so checkouts sharing a cache don't share bundles
+    source_path = os.path.abspath(source_path)
+    stem = os.path.splitext(os.path.basename(source_path))[0]
+    return os.path.join(directory, "{}-{:08x}.bundle".format(stem, zlib.crc32(source_path.encode("utf-8"))))
+
+def load(source_path: str, bundle_path: Optional[str]=None) -> Bundle:
+    # Like bytecode, the bundle is rebuilt whenever the content has changed
+    global FALLBACK_CACHE
+    stat = os.stat(source_path)
+    if bundle_path is not None:
+        return open_or_compile(source_path, bundle_path, stat)
+    try:
+        os.makedirs(cache_directory(), exist_ok=True)
+        return open_or_compile(source_path, cached_bundle_path(source_path, cache_directory()), stat)
+    except OSError:
+        if FALLBACK_CACHE is None:
+            FALLBACK_CACHE = tempfile.TemporaryDirectory(prefix="endless-")
+        return open_or_compile(source_path, cached_bundle_path(source_path, FALLBACK_CACHE.name), stat)
+
+def open_or_compile(source_path: str, bundle_path: str, stat: os.stat_result) -> Bundle:
+    try:
+        bundle = Bundle(bundle_path)
+        if bundle.source() == SourceSpec(stat.st_size, stat.st_mtime_ns):
+            return bundle
+        bundle.close()
+    except (OSError, ArchiveError, KeyError):
+        pass
+    compile_content(source_path, bundle_path)
+    return Bundle(bundle_path)
+
+if __name__ == "__main__":
+    # Compiles content ahead of time, so a game never has to at startup
+    parser = argparse.ArgumentParser(description="Compile game content to a bundle.")
+    parser.add_argument("source", help="the JSON content")
+    parser.add_argument("--output", help="where to write the bundle (by default, the cache directory)")
+    args = parser.parse_args()
+    try:
+        print(load(args.source, args.output).path)
+    except ContentError as e:
+        sys.exit(str(e))
@@ -0,0 +1,165 @@
+from typing import Any, Callable, Dict, IO, List, Optional, Tuple
+import functools
+import json
+import os
+import time
+
+import main
+import alice_in_antioch as antioch
+
+# Opt-in timers and call counters for the phases of Tomar's turns and Alice's decisions. Enabling
+# an Instrumentation swaps the functions below for timed wrappers, and disabling it puts the
+# originals back, so nothing is paid while it is off. Only code that looks the functions up through
+# their module or class at call time is seen: rollouts run in an executor's worker processes, and
+# batched rollouts (which step arrays rather than worlds), are timed as a whole but not per step.
+
+PHASES: Tuple[Tuple[str, Any, str], ...] = (
+    ("entity_turn", main, "entity_turn"),
+    ("entity_turn.parse_intent", main, "parse_intent"),
+    ("entity_turn.satisfaction", main, "check_satisfaction"),
+    ("entity_turn.advance_strategy", main, "advance_strategy"),
+    ("entity_turn.react_to_nonsense", main, "react_to_nonsense"),
+    ("entity_turn.react_to_lack_of_progress", main, "react_to_lack_of_progress"),
+    ("mind_act", antioch.Mind, "act"),
+    ("mind_act.generate_policies", antioch.Mind, "generate_possible_policies"),
+    ("mind_act.rollouts", antioch.Mind, "imagine_all"),
+    ("mind_act.world_step", antioch.World, "step"),
+    ("mind_act.goal_scoring", antioch.CompiledGoals, "satisfaction"),
+)
+
+# # # SINKS # # #
+
+class PhaseStats:
+    __slots__ = ('calls', 'seconds', 'min_seconds', 'max_seconds')
+
+    def __init__(self) -> None:
+        self.calls = 0
+        self.seconds = 0.0
+        self.min_seconds = float("inf")
+        self.max_seconds = 0.0
+
+    def add(self, seconds: float) -> None:
+        self.calls += 1
+        self.seconds += seconds
+        self.min_seconds = min(self.min_seconds, seconds)
+        self.max_seconds = max(self.max_seconds, seconds)
+
+class MemorySink:
+    # Aggregates every phase in memory
+    def __init__(self) -> None:
+        self.phases: Dict[str, PhaseStats] = {}
+
+    def record(self, phase: str, seconds: float) -> None:
+        stats = self.phases.get(phase)
+        if stats is None:
+            stats = self.phases[phase] = PhaseStats()
+        stats.add(seconds)
+
+    def flush(self) -> None:
+        pass
+
+class JsonLinesSink:
+    # One JSON object per timed call, written in batches
+    def __init__(self, stream: IO[str], batch_size: int=1000) -> None:
+        self.stream = stream
+        self.batch_size = batch_size
+        self.pending: List[str] = []
+
+    def record(self, phase: str, seconds: float) -> None:
+        self.pending.append(json.dumps({"phase": phase, "seconds": seconds, "time": time.time()}))
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def flush(self) -> None:
+        if self.pending:
+            self.stream.write("\n".join(self.pending) + "\n")
+            self.pending = []
+        self.stream.flush()
+
+class PrometheusSink(MemorySink):
+    # Aggregates in memory and rewrites a text exposition file (for node_exporter's textfile
+    # collector) on every flush, and at most every interval seconds while calls are being recorded.
+    # The file is replaced atomically so scrapes never see half of it.
+    def __init__(self, path: str, prefix: str="endless", interval: float=10.0) -> None:
+        super().__init__()
+        self.path = path
+        self.prefix = prefix
+        self.interval = interval
+        self.last_flush = time.monotonic()
+
+    def record(self, phase: str, seconds: float) -> None:
+        super().record(phase, seconds)
+        if time.monotonic() - self.last_flush >= self.interval:
+            self.flush()
+
+    def exposition(self) -> str:
+        lines = []
+        for metric, kind, value in (("phase_calls_total", "counter", lambda stats: stats.calls),
+                                    ("phase_seconds_total", "counter", lambda stats: stats.seconds),
+                                    ("phase_max_seconds", "gauge", lambda stats: stats.max_seconds)):
+            name = "{}_{}".format(self.prefix, metric)
+            lines.append("# TYPE {} {}".format(name, kind))
+            for phase in sorted(self.phases):
+                lines.append('{}{{phase="{}"}} {}'.format(name, phase, repr(float(value(self.phases[phase])))))
+        return "\n".join(lines) + "\n"
+
+    def flush(self) -> None:
+        temporary = self.path + ".tmp"
+        with open(temporary, "w") as f:
+            f.write(self.exposition())
+        os.replace(temporary, self.path)
+        self.last_flush = time.monotonic()
+
+# # # HOOKS # # #
+
+def timed(phase: str, function: Callable[..., Any], sink: Any) -> Callable[..., Any]:
+    clock = time.perf_counter
+    record = sink.record
+
+    @functools.wraps(function)
+    def wrapper(*args: Any, **kwargs: Any) -> Any:
+        start = clock()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            record(phase, clock() - start)
+    return wrapper
+
+class Instrumentation:
+    # Usable as a context manager. Only one should be enabled at a time.
+    def __init__(self, sink: Any, phases: Tuple[Tuple[str, Any, str], ...]=PHASES) -> None:
+        self.sink = sink
+        self.phases = phases
+        self.originals: Optional[List[Tuple[Any, str, Any]]] = None
+
+    @property
+    def enabled(self) -> bool:
+        return self.originals is not None
+
+    def enable(self) -> None:
+        if self.originals is not None:
+            return
+        self.originals = []
+        for phase, owner, attribute in self.phases:
+            original = vars(owner)[attribute]
+            self.originals.append((owner, attribute, original))
+            setattr(owner, attribute, timed(phase, original, self.sink))
+
+    def disable(self) -> None:
+        if self.originals is None:
+            return
+        for owner, attribute, original in reversed(self.originals):
+            setattr(owner, attribute, original)
+        self.originals = None
+        self.sink.flush()
+
+    def flush(self) -> None:
+        # For long-running processes, which may want to export what has been recorded so far
+        self.sink.flush()
+
+    def __enter__(self) -> 'Instrumentation':
+        self.enable()
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.disable()
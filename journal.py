@@ -0,0 +1,180 @@
+from typing import BinaryIO, Dict, List, Optional, Tuple
+import os
+import re
+import struct
+import time
+import zlib
+
+import archives
+import main
+import snapshots
+
+# Every turn is a pure transition of a GameState, so a session is its starting state plus the
+# speech it has been fed. Sessions are kept as an append-only journal of those events with periodic
+# snapshots; recovering from a crash loads the latest snapshot lazily and replays only the events
+# journaled after it.
+#
+# A directory holds one generation of each: snapshot-N.snap, the sessions as they were when the
+# journal journal-N.log was started. The first generation has no snapshot. A checkpoint writes the
+# next generation's snapshot before starting its journal, then removes the older generation.
+
+START = 0  # The session starts a new game
+SPEECH = 1  # The session is fed a line of speech
+
+RECORD = struct.Struct("<IIBH")  # Length of the rest, CRC32 of the rest, event kind, session length
+GENERATION_FILE = re.compile(r"(snapshot|journal)-(\d+)\.(snap|log)$")
+
+def snapshot_path(directory: str, generation: int) -> str:
+    return os.path.join(directory, "snapshot-{:08d}.snap".format(generation))
+
+def journal_path(directory: str, generation: int) -> str:
+    return os.path.join(directory, "journal-{:08d}.log".format(generation))
+
+def encode_event(kind: int, session: str, speech: str) -> bytes:
+    session_data = session.encode("utf-8")
+    rest = struct.pack("<BH", kind, len(session_data)) + session_data + speech.encode("utf-8")
+    return struct.pack("<II", len(rest), zlib.crc32(rest)) + rest
+
+def read_journal(path: str) -> Tuple[List[Tuple[int, str, str]], int]:
+    # The events, and how many bytes of the file hold them. Reading stops at the first record that
+    # was only partly written when the process died.
+    with open(path, "rb") as f:
+        data = f.read()
+    events = []
+    position = 0
+    while position + RECORD.size <= len(data):
+        length, checksum, kind, session_length = RECORD.unpack_from(data, position)
+        rest = data[position + 8:position + 8 + length]
+        if len(rest) < length or zlib.crc32(rest) != checksum:
+            break
+        events.append((kind, rest[3:3 + session_length].decode("utf-8"), rest[3 + session_length:].decode("utf-8")))
+        position += 8 + length
+    return events, position
+
+class Journal:
+    # Events are written and fsynced in batches: when batch_size are waiting, when the oldest has
+    # waited max_delay seconds by the time another arrives, or when synced. Nothing flushes an idle
+    # journal by itself, so a server should call sync when it has nothing else to do.
+    def __init__(self, path: str, batch_size: int=256, max_delay: float=0.01) -> None:
+        self.file: BinaryIO = open(path, "ab")
+        archives.sync_directory(os.path.dirname(os.path.abspath(path)))  # So a new journal isn't lost
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.pending: List[bytes] = []
+        self.oldest_pending = 0.0
+
+    def append(self, kind: int, session: str, speech: str="") -> None:
+        if not self.pending:
+            self.oldest_pending = time.monotonic()
+        self.pending.append(encode_event(kind, session, speech))
+        if len(self.pending) >= self.batch_size or time.monotonic() - self.oldest_pending >= self.max_delay:
+            self.sync()
+
+    def sync(self) -> None:
+        if self.pending:
+            self.file.write(b"".join(self.pending))
+            self.pending = []
+            self.file.flush()
+            os.fsync(self.file.fileno())
+
+    def close(self) -> None:
+        self.sync()
+        self.file.close()
+
+class SessionStore:
+    # Sessions by name, advanced with main.advance_game. Sessions untouched since the last snapshot
+    # stay in the snapshot archive until they are asked for.
+    def __init__(self, directory: str, snapshot_every: int=100000, batch_size: int=256, max_delay: float=0.01) -> None:
+        self.directory = directory
+        self.snapshot_every = snapshot_every
+        self.batch_size = batch_size
+        self.max_delay = max_delay
+        self.states: Dict[str, Optional[main.GameState]] = {}  # None for sessions that have ended
+        self.archive: Optional[snapshots.Archive] = None
+        self.events_since_snapshot = 0
+        self.replayed = 0  # Journaled events replayed by recovery
+
+        os.makedirs(directory, exist_ok=True)
+        generations = [int(match.group(2)) for match in map(GENERATION_FILE.match, os.listdir(directory))
+                       if match and match.group(1) == "snapshot"]
+        self.generation = max(generations, default=0)
+        if generations:
+            self.archive = snapshots.open_sessions(snapshot_path(directory, self.generation))
+        if os.path.exists(journal_path(directory, self.generation)):
+            events, length = read_journal(journal_path(directory, self.generation))
+            for kind, session, speech in events:
+                self.apply(kind, session, speech)
+            os.truncate(journal_path(directory, self.generation), length)  # New events follow the last whole one
+            self.replayed = self.events_since_snapshot = len(events)
+        self.journal = Journal(journal_path(directory, self.generation), batch_size, max_delay)
+        self.remove_older_generations()
+
+    def get(self, session: str) -> Optional[main.GameState]:
+        if session not in self.states:
+            self.states[session] = self.archive[session] if self.archive is not None and session in self.archive else None
+        return self.states[session]
+
+    def apply(self, kind: int, session: str, speech: str) -> List[str]:
+        if kind == START:
+            self.states[session], lines = main.start_game()
+            return lines
+        state = self.get(session)
+        if state is None:
+            raise KeyError(session)
+        self.states[session], lines = main.advance_game(state, speech)
+        return lines
+
+    def record(self, kind: int, session: str, speech: str="") -> List[str]:
+        # Only turns that succeed are journaled, so a turn that raised is never replayed
+        lines = self.apply(kind, session, speech)
+        self.journal.append(kind, session, speech)
+        self.events_since_snapshot += 1
+        if self.events_since_snapshot >= self.snapshot_every:
+            self.checkpoint()
+        return lines
+
+    def start(self, session: str) -> List[str]:
+        return self.record(START, session)
+
+    def feed(self, session: str, speech: str) -> List[str]:
+        return self.record(SPEECH, session, speech)
+
+    def sessions(self) -> Dict[str, main.GameState]:
+        result = {}
+        if self.archive is not None:
+            for session in self.archive:
+                if session not in self.states:
+                    result[session] = self.archive[session]
+        for session, state in self.states.items():
+            if state is not None:
+                result[session] = state
+        return result
+
+    def checkpoint(self) -> None:
+        self.journal.sync()
+        sessions = self.sessions()
+        snapshots.save_sessions(snapshot_path(self.directory, self.generation + 1), sessions)
+        self.journal.close()
+        if self.archive is not None:
+            self.archive.close()
+        self.generation += 1
+        self.archive = snapshots.open_sessions(snapshot_path(self.directory, self.generation))
+        self.states = {}
+        self.events_since_snapshot = 0
+        self.journal = Journal(journal_path(self.directory, self.generation), self.batch_size, self.max_delay)
+        self.remove_older_generations()
+
+    def remove_older_generations(self) -> None:
+        removed = False
+        for name in os.listdir(self.directory):
+            match = GENERATION_FILE.match(name)
+            if match and int(match.group(2)) < self.generation:
+                os.remove(os.path.join(self.directory, name))
+                removed = True
+        if removed:
+            archives.sync_directory(self.directory)
+
+    def close(self) -> None:
+        self.journal.close()
+        if self.archive is not None:
+            self.archive.close()
@@ -1,6 +1,9 @@
-from typing import NamedTuple, Callable, FrozenSet, Optional, Union, Tuple
+import functools
+import os
+from typing import Any, NamedTuple, Callable, Dict, FrozenSet, Iterable, List, Optional, Union, Tuple
 
 import basic_io as io
+import content
 
 # # # TYPES # # #
 
@@ -9,10 +12,10 @@ class Mind(NamedTuple):
     seized_by_player: bool
     confusion: int
     impatience: int
-    beliefs: FrozenSet[str]
+    beliefs: int  # Bitmask of beliefs interned in BELIEFS
     statements_of_confusion: Tuple[Optional[str], ...]
     statements_of_impatience: Tuple[Optional[str], ...]
-    cached_strategy: Optional['Strategy']
+    cached_strategy: Optional[int]  # Node id in STRATEGIES
     primary_control_system: Optional['ControlSystem']
 
 class Location(NamedTuple):
@@ -25,16 +28,69 @@ class Location(NamedTuple):
 class Action(NamedTuple):
     summary: str
 
+# A whole game as a value: the screen waiting for input and the state of play
+class GameState(NamedTuple):
+    screen: str  # A menu name, or PLAYING
+    tomar: Mind
+    location: Location
+
+# A GameState as plain values, naming control systems and beliefs, so it can be saved and compared
+# across processes or versions of the game
+class GameSnapshot(NamedTuple):
+    screen: str
+    seized_by_player: bool
+    confusion: int
+    impatience: int
+    beliefs: Tuple[str, ...]
+    statements_of_confusion: Tuple[Optional[str], ...]
+    statements_of_impatience: Tuple[Optional[str], ...]
+    cached_strategy: Optional[str]  # Strategy node name in STRATEGIES
+    primary_control_system: Optional[str]
+    location: Location
+
 class ConfusionDetails(NamedTuple):
     suggestions: Tuple[str, ...]
     explanation: str
 
+# Beliefs are interned to bit positions, so a set of beliefs is an int and updating or testing it
+# is a single integer operation
+class BeliefRegistry:
+    def __init__(self) -> None:
+        self.bits: Dict[str, int] = {}
+
+    def bit(self, belief: str) -> int:
+        if belief not in self.bits:
+            self.bits[belief] = 1 << len(self.bits)
+        return self.bits[belief]
+
+    def mask(self, beliefs: Iterable[str]) -> int:
+        result = 0
+        for belief in beliefs:
+            result |= self.bit(belief)
+        return result
+
+    def holds(self, beliefs: int, belief: str) -> bool:
+        return bool(beliefs & self.bit(belief))
+
+    def names(self, beliefs: int) -> FrozenSet[str]:
+        return frozenset(belief for belief, bit in self.bits.items() if beliefs & bit)
+
+# A condition on a single belief, which StrategyGraph can compile to a bit test
+class Believes:
+    def __init__(self, belief: str, holds: bool = True) -> None:
+        self.belief = belief
+        self.holds = holds
+        self.bit = BELIEFS.bit(belief)
+
+    def __call__(self, mind: Mind) -> bool:
+        return bool(mind.beliefs & self.bit) == self.holds
+
 class ConditionalStrategy(NamedTuple):
     condition: Callable[[Mind], bool]
     then: 'Strategy'
 
 class StrategyFork(NamedTuple):
-    check: Union[ConditionalStrategy, Tuple[ConditionalStrategy]]
+    check: Union[ConditionalStrategy, Tuple[ConditionalStrategy, ...]]
     fallback: 'Strategy'
 
 # These are instantiated as base classes rather than NamedTuples to avoid "recursive types"
@@ -53,6 +109,65 @@ class Strategy:
     def onward(self) -> Union[None, 'Strategy', StrategyFork]:
         return self._onward
 
+class Transition(NamedTuple):
+    required: int  # Belief bits that must all be held
+    forbidden: int  # Belief bits that must all be absent
+    predicate: Optional[Callable[[Mind], bool]]  # Any condition that couldn't be compiled to bits
+    target: Optional[int]  # Node id, or None where the strategy ends
+
+# Strategy trees compiled into a table indexed by node id. Each node has its active control
+# system and an ordered tuple of transitions; the first whose condition holds is taken.
+class StrategyGraph:
+    def __init__(self) -> None:
+        self.node_ids: Dict['Strategy', int] = {}
+        self.active: List['ControlSystem'] = []  # Indexed by node id
+        self.transitions: List[Tuple[Transition, ...]] = []  # Indexed by node id
+
+    def compile(self, strategy: 'Strategy') -> int:
+        if strategy in self.node_ids:
+            return self.node_ids[strategy]
+        node = len(self.active)
+        self.node_ids[strategy] = node
+        self.active.append(strategy.active)
+        self.transitions.append(())
+        onward = strategy.onward
+        if isinstance(onward, StrategyFork):
+            options = (onward.check,) if isinstance(onward.check, ConditionalStrategy) else onward.check
+            self.transitions[node] = tuple(self.compile_condition(option.condition, self.compile(option.then))
+                                           for option in options)
+            self.transitions[node] += (Transition(0, 0, None, self.compile(onward.fallback)),)
+        else:
+            self.transitions[node] = (Transition(0, 0, None, self.compile(onward) if onward else None),)
+        return node
+
+    def compile_condition(self, condition: Callable[[Mind], bool], target: int) -> Transition:
+        if isinstance(condition, Believes):
+            if condition.holds:
+                return Transition(condition.bit, 0, None, target)
+            return Transition(0, condition.bit, None, target)
+        return Transition(0, 0, condition, target)
+
+    def node_name(self, node: int) -> str:
+        # Stable ids for saved games: a node is named for its active control system, and numbered in
+        # compile order only if several nodes run the same one
+        system = self.active[node]
+        occurrence = self.active[:node].count(system)
+        return CONTROL_SYSTEM_NAMES[system] + ("" if occurrence == 0 else "#{}".format(occurrence + 1))
+
+    def node_named(self, name: str) -> int:
+        for node in range(len(self.active)):
+            if self.node_name(node) == name:
+                return node
+        raise KeyError(name)
+
+    def advance(self, node: int, mind: Mind) -> Optional[int]:
+        beliefs = mind.beliefs
+        for transition in self.transitions[node]:
+            if (beliefs & transition.required == transition.required and not beliefs & transition.forbidden
+                    and (transition.predicate is None or transition.predicate(mind))):
+                return transition.target
+        return None
+
 class ControlSystem:
     def __init__(self,
                  name: str,
@@ -68,7 +183,17 @@ class ControlSystem:
         self.say_on_progress = say_on_progress
         self.say_on_return_without_progress = say_on_return_without_progress
 
-# # # CONTROL SYSTEMS # # #
+# # # BELIEFS # # #
+
+BELIEFS = BeliefRegistry()
+MASTER_CAN_CAST_SPELLS = BELIEFS.bit("Master can cast spells")
+BINDING_HAS_PROBLEMS = BELIEFS.bit("the binding appears to have problems")
+CAN_BE_SEIZED = BELIEFS.bit("I can be seized")
+
+# # # RESPONSES # # #
+
+# What control systems say is mostly written as content, but responses that depend on the mind
+# are functions, which content calls by name
 
 def respond_master_cast_a_spell(player_intent: str, mind: Mind) -> str:
     if mind.confusion > 0:
@@ -77,54 +202,23 @@ def respond_master_cast_a_spell(player_intent: str, mind: Mind) -> str:
         return response
     else:
         return "The binding appears to be a success. Shall we continue with the tests?"
-wait_for_master_to_cast_a_spell = ControlSystem(
-    name='waiting for you to demonstrate that the binding was a success by invoking _shta_',
-    is_satisfied=lambda mind: "Master can cast spells" in mind.beliefs,
-    init_action=None,
-    confusion_details=ConfusionDetails(
-        suggestions=(
-            "Perhaps you should _shta_?",
-            "I encourage you to _shta_ to get your bearings.",
-            "If you _shta_ it might help you understand.",
-        ),
-        explanation="The binding must have disoriented you.",
-    ),
-    say_on_progress=respond_master_cast_a_spell,
-    say_on_return_without_progress=None,
-)
 
 def respond_asked_about_starting_tests(player_intent: str, mind: Mind) -> str:
     if player_intent == "unknown" and mind.impatience == 0:
         return "I don't understand you. Something must've gone wrong. I'll head downstairs..."
     else:
         return "Hrm. Yes, I think we should continue with the testing..."
-ask_about_starting_tests = ControlSystem(
-    name="asking you whether I can start the tests",
-    is_satisfied=lambda mind: ("the binding appears to have problems" in mind.beliefs or mind.impatience > 0),
-    init_action=None,
-    say_on_progress=respond_asked_about_starting_tests,
-    say_on_return_without_progress=lambda mind: "Does this mean we should start?",
-    confusion_details=None,
-)
 
 def respond_checked_for_objection_to_begin_tests(player_intent: str, mind: Mind) -> str:
     if player_intent == "unknown":
         return "Yes, I think continuing with the tests is a good idea. You're not making any sense."
     else:
         return "I'm heading downstairs to begin the tests..."
-check_for_objection_to_begin_tests = ControlSystem(
-    name='checking whether I can start the tests',
-    is_satisfied=lambda mind: True,
-    init_action=None,
-    say_on_progress=respond_checked_for_objection_to_begin_tests,
-    say_on_return_without_progress=None,
-    confusion_details=None,
-)
 
 def respond_tests_have_started(player_intent: str, mind: Mind) -> str:
     if player_intent == "unknown":
         results = "Alright. We're here. Let's see if we can figure out why you're not making sense.\n"
-        results += "Try another " if "I can be seized" in mind.beliefs else "Try "
+        results += "Try another " if mind.beliefs & CAN_BE_SEIZED else "Try "
         results += "_shak_ and we'll start the first test.\n"
     elif player_intent == "shta":
         results = "Yes, here we are, Master. Go ahead and _shak_ so we may begin the first test.\n"
@@ -134,97 +228,156 @@ def respond_tests_have_started(player_intent: str, mind: Mind) -> str:
         raise NotImplementedError()
     results += "Once in control of me, _chai_ _reho_ the target, and then _shak_ again to finish the test."
     return results
-start_the_tests = ControlSystem(
-    name="starting the tests for your binding",
-    is_satisfied=lambda mind: True,
-    init_action=Action('go downstairs'),
-    say_on_progress=respond_tests_have_started,
-    say_on_return_without_progress=None,
-    confusion_details=None,
-)
 
 def give_hint_for_first_test(mind: Mind) -> str:
     return "Did something go wrong? The target appears undamaged.\nYou'll need to _chai_ then _reho_ the target to complete the test."
-wait_for_target_to_be_destroyed = ControlSystem(
-    name='testing whether you can invoke _chai_ _reho_',
-    is_satisfied=lambda mind: False,
-    init_action=None,
-    say_on_progress=lambda player_intent, mind: "raise NotImplementedError()",
-    say_on_return_without_progress=give_hint_for_first_test,
-    confusion_details=ConfusionDetails(
-        suggestions=(
-            "I think you should _shak_, then _chai_ _reho_.",
-            "If you _shak_ down here we can make progress towards figuring out what went wrong.",
-            "If you _shak_, you'll be able to harness _chai_ and then _reho_.",
-        ),
-        explanation="The binding went wrong somehow.",
-    ),
-)
 
-# # # STRATEGIES # # #
+RESPONSES: Dict[str, Callable[..., str]] = {
+    'respond_master_cast_a_spell': respond_master_cast_a_spell,
+    'respond_asked_about_starting_tests': respond_asked_about_starting_tests,
+    'respond_checked_for_objection_to_begin_tests': respond_checked_for_objection_to_begin_tests,
+    'respond_tests_have_started': respond_tests_have_started,
+    'give_hint_for_first_test': give_hint_for_first_test,
+}
+
+# # # CONTENT # # #
+
+# Control systems, strategies, characters and places are compiled from content/endless.json (see
+# content.py) and built from the bundle the first time each is asked for. Everything built is
+# cached, so a control system or strategy node is the same object however it was reached.
+
+CONTENT_SOURCE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "content", "endless.json")
+
+@functools.lru_cache(maxsize=None)
+def game_content() -> content.Bundle:
+    # Compiled or opened on first use rather than on import
+    return content.load(CONTENT_SOURCE)
+
+PREDICATES: Dict[int, Callable[[Mind], bool]] = {}  # By bundle id
+
+def load_predicate(predicate_id: int) -> Callable[[Mind], bool]:
+    if predicate_id not in PREDICATES:
+        spec = game_content().predicate(predicate_id)
+        operands = [load_predicate(operand) for operand in spec.operands]
+        predicate: Callable[[Mind], bool]
+        if spec.kind == "believes" and spec.belief is not None:
+            predicate = Believes(spec.belief, spec.holds)
+        elif spec.kind == "always":
+            predicate = (lambda mind: True) if spec.holds else (lambda mind: False)
+        elif spec.kind == "impatience_above":
+            predicate = lambda mind: mind.impatience > spec.threshold
+        elif spec.kind == "confusion_above":
+            predicate = lambda mind: mind.confusion > spec.threshold
+        elif spec.kind == "any":
+            predicate = lambda mind: any(operand(mind) for operand in operands)
+        elif spec.kind == "all":
+            predicate = lambda mind: all(operand(mind) for operand in operands)
+        else:
+            raise content.ContentError("Unknown predicate {}".format(spec.kind))
+        PREDICATES[predicate_id] = predicate
+    return PREDICATES[predicate_id]
+
+def load_response(response_id: int, on_return: bool) -> Callable[..., str]:
+    # Responses on progress are called with the player's intent and the mind, those on returning
+    # without progress with just the mind
+    spec = game_content().response(response_id)
+    if spec.kind == "call":
+        if spec.text not in RESPONSES:
+            raise content.ContentError("No response function named {}".format(spec.text))
+        return RESPONSES[spec.text]
+    if on_return:
+        return lambda mind: spec.text
+    return lambda player_intent, mind: spec.text
+
+# Stable names for control systems, used when saving minds
+CONTROL_SYSTEMS: Dict[str, 'ControlSystem'] = {}
+CONTROL_SYSTEM_NAMES: Dict['ControlSystem', str] = {}
+
+def control_system(name: str) -> 'ControlSystem':
+    if name not in CONTROL_SYSTEMS:
+        spec = game_content().control_system(game_content().control_system_id(name))
+        system = ControlSystem(
+            name=spec.name,
+            is_satisfied=load_predicate(spec.is_satisfied),
+            init_action=Action(spec.init_action) if spec.init_action is not None else None,
+            confusion_details=(ConfusionDetails(spec.confusion_suggestions, spec.confusion_explanation)
+                               if spec.confusion_suggestions is not None and spec.confusion_explanation is not None
+                               else None),
+            say_on_progress=load_response(spec.say_on_progress, on_return=False),
+            say_on_return_without_progress=(load_response(spec.say_on_return_without_progress, on_return=True)
+                                            if spec.say_on_return_without_progress is not None else None),
+        )
+        CONTROL_SYSTEMS[name] = system
+        CONTROL_SYSTEM_NAMES[system] = name
+    return CONTROL_SYSTEMS[name]
+
+LOADED_STRATEGIES: Dict[int, Strategy] = {}  # By bundle node id
+
+def load_strategy(node: int) -> Strategy:
+    if node not in LOADED_STRATEGIES:
+        spec = game_content().strategy_node(node)
+        active = control_system(game_content().control_system(spec.control_system).key)
+        # Strategies can lead back to themselves, so each is loaded before where it leads
+        strategy = LOADED_STRATEGIES[node] = Strategy(active, None)
+        onward: Union[None, Strategy, StrategyFork]
+        *checks, (_, fallback) = spec.transitions  # The last transition always holds
+        if checks and fallback is not None:
+            onward = StrategyFork(
+                check=tuple(ConditionalStrategy(load_predicate(predicate), load_strategy(target))
+                            for predicate, target in checks if predicate is not None and target is not None),
+                fallback=load_strategy(fallback),
+            )
+        else:
+            onward = load_strategy(fallback) if fallback is not None else None
+        strategy._onward = onward
+    return LOADED_STRATEGIES[node]
+
+def strategy(name: str) -> Strategy:
+    return load_strategy(game_content().strategy(name))
 
-test_master = Strategy(
-    active=start_the_tests,
-    onward=Strategy(
-        active=wait_for_target_to_be_destroyed,
-        onward=None,
-    ),
-)
+STRATEGIES = StrategyGraph()
 
-test_binding = Strategy(
-    active=wait_for_master_to_cast_a_spell,
-    onward=StrategyFork(
-        check=ConditionalStrategy(
-            condition=lambda mind: 'the binding appears to have problems' not in mind.beliefs,
-            then=Strategy(
-                active=ask_about_starting_tests,
-                onward=test_master,
-            ),
-        ),
-        fallback=Strategy(
-            active=check_for_objection_to_begin_tests,
-            onward=test_master,
-        ),
-    ),
-)
+@functools.lru_cache(maxsize=None)
+def load_npc(key: str) -> Mind:
+    spec = game_content().npc(key)
+    cached_strategy = STRATEGIES.compile(load_strategy(spec.strategy))
+    return Mind(
+        seized_by_player=False,
+        confusion=0,
+        impatience=0,
+        beliefs=0,
+        cached_strategy=cached_strategy,
+        primary_control_system=STRATEGIES.active[cached_strategy],
+        statements_of_confusion=spec.statements_of_confusion,
+        statements_of_impatience=spec.statements_of_impatience,
+    )
+
+@functools.lru_cache(maxsize=None)
+def load_location(key: str) -> Location:
+    spec = game_content().location(key)
+    return Location(spec.name, spec.perception, spec.position, spec.nature, spec.foci)
 
 # # # TOMAR # # #
 
-TOMAR = Mind(
-    seized_by_player=False,
-    confusion=0,
-    impatience=0,
-    beliefs=frozenset(),
-    cached_strategy=test_binding,
-    primary_control_system=wait_for_master_to_cast_a_spell,
-    statements_of_confusion=(
-        "I don't understand, Master.",
-        "I still don't understand what you're trying to say.\n{suggestions[0]}",
-        "{explanation} {suggestions[1]}",
-        "I don't understand, Master.",
-        "{suggestions[2]}",
-        "Please Master, I'm trying.",
-        "I don't understand.",
-        "Have I displeased you?",
-        "I await a command that I can comprehend.",
-        "Master, your thoughts are madness. Please say something in Liltish.",
-        "Please!",
-        "...",
-        None,
-        "Perhaps something is wrong.",
-        "I will meditate on the problem.",
-        "When you are ready to _shta_ or anything else that makes sense, I will respond.",
-        "..."
-    ),
-    statements_of_impatience=(
-        None,
-        "Any time now...",
-        None,
-    ),
-)
+# Tomar and the places of the game are module attributes, loaded when they are first looked up
+LAZY_CONTENT = {
+    "TOMAR": (load_npc, "tomar"),
+    "STARTING_LABORATORY": (load_location, "starting_laboratory"),
+    "TRAINING_HALL": (load_location, "training_hall"),
+}
+
+def __getattr__(name: str) -> Any:
+    if name in LAZY_CONTENT:
+        load, key = LAZY_CONTENT[name]
+        return load(key)
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
 
 # # # SPELLS # # #
 
+# Spell descriptions depend only on immutable values, so each distinct one is rendered once.
+# The caches are bounded in case locations are ever generated rather than written by hand.
+
+@functools.lru_cache(maxsize=256)
 def spell__shta(location: Location) -> str:
     result = "+--"
     result += "\n|Perception: " + location.perception
@@ -235,20 +388,24 @@ def spell__shta(location: Location) -> str:
     result += "\n+--"
     return result
 
-def spell_shak(tomar: Mind, location: Location) -> Tuple[Mind, str]:
-    tomar = tomar._replace(
-        seized_by_player=not tomar.seized_by_player,
-        primary_control_system=None,
-        confusion=0,
-        impatience=0)
+@functools.lru_cache(maxsize=2)
+def describe_shak(seized_by_player: bool) -> str:
     result = "+--"
-    if tomar.seized_by_player:
+    if seized_by_player:
         result += "\n|Tomar's mind yields before your power."
         result += "\n|Your aura is empty."
     else:
         result += "\n|You release Tomar's mind."
     result += "\n+--"
-    return tomar, result
+    return result
+
+def spell_shak(tomar: Mind, location: Location) -> Tuple[Mind, str]:
+    tomar = tomar._replace(
+        seized_by_player=not tomar.seized_by_player,
+        primary_control_system=None,
+        confusion=0,
+        impatience=0)
+    return tomar, describe_shak(tomar.seized_by_player)
 
 def spell_chai(tomar: Mind, location: Location) -> Tuple[Mind, str]:
     raise NotImplementedError()
@@ -268,6 +425,10 @@ def attempt_spell(speech: str, tomar: Mind, location: Location) -> Tuple[Mind, O
         tomar, description = spell_reho(tomar, location)
     return tomar, description
 
+@functools.lru_cache(maxsize=1024)
+def render_confusion(statement: str, details: ConfusionDetails) -> str:
+    return statement.format(**details._asdict())
+
 def react_to_nonsense(mind: Mind) -> Tuple[Mind, Optional[str]]:
     response = None
     try:
@@ -275,10 +436,10 @@ def react_to_nonsense(mind: Mind) -> Tuple[Mind, Optional[str]]:
     except IndexError:  # type: ignore
         response = mind.statements_of_confusion[-1]
     if response and mind.primary_control_system and mind.primary_control_system.confusion_details:
-        response = response.format(**mind.primary_control_system.confusion_details._asdict())
+        response = render_confusion(response, mind.primary_control_system.confusion_details)
     mind = mind._replace(
         confusion=mind.confusion + 1,
-        beliefs=mind.beliefs | {'the binding appears to have problems'},
+        beliefs=mind.beliefs | BINDING_HAS_PROBLEMS,
     )
     return mind, response
 
@@ -294,38 +455,34 @@ def react_to_lack_of_progress(mind: Mind) -> Tuple[Mind, Optional[str]]:
 
 def build_primary_control_system(mind: Mind, location: Location) -> ControlSystem:
     if mind.cached_strategy is not None:
-        return mind.cached_strategy.active
+        return STRATEGIES.active[mind.cached_strategy]
     else:
         raise NotImplementedError()
 
-def evaluate_fork(fork: StrategyFork, mind: Mind) -> Optional[Strategy]:
-    if isinstance(fork.check, ConditionalStrategy):
-        if fork.check.condition(mind):
-            return fork.check.then
-    else:
-        for option in fork.check:
-            if option.condition(mind):
-                return option.then
-    return fork.fallback
-
 def advance_strategy(mind: Mind) -> Tuple[Mind, Optional[Action]]:
-    if mind.cached_strategy:
-        if isinstance(mind.cached_strategy.onward, StrategyFork):
-            next_strategy = evaluate_fork(mind.cached_strategy.onward, mind)
-        else:
-            next_strategy = mind.cached_strategy.onward
-        mind = mind._replace(cached_strategy=next_strategy)
+    if mind.cached_strategy is not None:
+        mind = mind._replace(cached_strategy=STRATEGIES.advance(mind.cached_strategy, mind))
     else:
         raise NotImplementedError()
 
     action = None
-    if mind.cached_strategy:
-        mind = mind._replace(primary_control_system=mind.cached_strategy.active)
+    if mind.cached_strategy is not None:
+        mind = mind._replace(primary_control_system=STRATEGIES.active[mind.cached_strategy])
         if mind.primary_control_system and mind.primary_control_system.init_action:
             action = mind.primary_control_system.init_action
 
     return mind, action
 
+def parse_intent(speech: str) -> str:
+    if speech in ["shta", "shak"]:
+        return speech
+    elif speech in ["chai", "reho"]:
+        return "battle_magic"
+    return "unknown"
+
+def check_satisfaction(mind: Mind) -> bool:
+    return mind.primary_control_system is not None and mind.primary_control_system.is_satisfied(mind)
+
 def entity_turn(original_mind: Mind, location: Location, speech: str) -> Tuple[Mind, Optional[str], Optional[Action]]:
     mind = original_mind
     response = None
@@ -334,23 +491,17 @@ def entity_turn(original_mind: Mind, location: Location, speech: str) -> Tuple[M
     if mind.seized_by_player:
         return mind, response, action
 
-    player_intent = "unknown"
-    if speech == "shta":
-        player_intent = "shta"
-        mind = mind._replace(beliefs=mind.beliefs | {"Master can cast spells"})
-    elif speech == "shak":
-        player_intent = "shak"
-        mind = mind._replace(beliefs=mind.beliefs | {"Master can cast spells"})
-    elif speech in ["chai", "reho"]:
-        player_intent = "battle_magic"
+    player_intent = parse_intent(speech)
+    if player_intent in ["shta", "shak"]:
+        mind = mind._replace(beliefs=mind.beliefs | MASTER_CAN_CAST_SPELLS)
 
     if mind.primary_control_system is None:
-        mind = mind._replace(beliefs=mind.beliefs | {"I can be seized"})
+        mind = mind._replace(beliefs=mind.beliefs | CAN_BE_SEIZED)
         response = "Thank you for using me, Master.\nPlease give me a moment to collect myself.\n...\n"
         mind = mind._replace(primary_control_system=build_primary_control_system(mind, location))
         if mind.primary_control_system:  # Guaranteed. This check is just for typechecking safety.
             response += "I seem to remember something about " + mind.primary_control_system.name + '...\n'
-            satisfaction = mind.primary_control_system.is_satisfied(mind)
+            satisfaction = check_satisfaction(mind)
             if satisfaction:
                 response += mind.primary_control_system.say_on_progress(player_intent, mind)
                 mind, action = advance_strategy(mind)
@@ -359,7 +510,7 @@ def entity_turn(original_mind: Mind, location: Location, speech: str) -> Tuple[M
                     response += mind.primary_control_system.say_on_return_without_progress(mind)
 
     else:
-        satisfaction = mind.primary_control_system.is_satisfied(mind)
+        satisfaction = check_satisfaction(mind)
         if satisfaction:
             response = mind.primary_control_system.say_on_progress(player_intent, mind)
             mind, action = advance_strategy(mind)
@@ -377,47 +528,60 @@ def entity_turn(original_mind: Mind, location: Location, speech: str) -> Tuple[M
 
     return mind, response, action
 
-def play_game(get_input: io.Input, output: io.Output) -> None:
-    tomar: Mind = TOMAR
-    location = Location(
-        name="Starting Laboratory",
-        perception="I'm in Master's laboratory. Everything is as it should be.",
-        position="36 degrees and 4101 meters from the _guhi_ nexus, 12 meters above the weave",
-        nature=("Stone", "Artifice", "Arcana"),
-        foci=(),
-    )
+# # # GAME # # #
+
+def play_turn(tomar: Mind, location: Location, speech: str) -> Tuple[Mind, Location, List[str]]:
+    outputs = []
+    tomar, spell_says = attempt_spell(speech, tomar, location)
+    if spell_says:
+        outputs.append(spell_says)
+    tomar, tomar_says, tomar_does = entity_turn(tomar, location, speech)
+    if tomar_says:
+        outputs.append(tomar_says)
+    if tomar_does:
+        location = load_location("training_hall")
+    return tomar, location, outputs
 
-    speech = None
+# A game in progress that is driven one line of speech at a time rather than by blocking on input.
+# All of its state is the immutable Mind and Location, so sessions are cheap to keep in bulk.
+class GameSession:
+    __slots__ = ('tomar', 'location')
 
-    output("")
-    output("What say you, Master?")
+    def __init__(self, tomar: Optional[Mind] = None, location: Optional[Location] = None) -> None:
+        self.tomar = tomar if tomar is not None else load_npc("tomar")
+        self.location = location if location is not None else load_location("starting_laboratory")
+
+    def greet(self) -> List[str]:
+        return ["", "What say you, Master?"]
+
+    def feed(self, speech: str) -> List[str]:
+        self.tomar, self.location, outputs = play_turn(self.tomar, self.location, speech)
+        return outputs
+
+def play_game(get_input: io.Input, output: io.Output) -> None:
+    session = GameSession()
+    for line in session.greet():
+        output(line)
     while True:
-        speech = get_input()
-        tomar, spell_says = attempt_spell(speech, tomar, location)
-        if spell_says:
-            output(spell_says)
-        tomar, tomar_says, tomar_does = entity_turn(tomar, location, speech)
-        if tomar_says:
-            output(tomar_says)
-        if tomar_does:
-            location = Location(
-                name="Training Hall",
-                perception="I'm in the training hall below Master's lab. The test aparatus is ready.",
-                position="36 degrees and 4101 meters from the _guhi_ nexus, 9.5 meters above the weave",
-                nature=("Stone", "Artifice", "Metal"),
-                foci=("Target",),
-            )
+        for line in session.feed(get_input()):
+            output(line)
+
+HELP = (
+    "Endless is a minimal, single-player version of Waving Hands.",
+    "See: http://www.gamecabinet.com/rules/WavingHands.html",
+)
 
 def show_help(get_input: io.Input, output: io.Output) -> None:
-    output("Endless is a minimal, single-player version of Waving Hands.")
-    output("See: http://www.gamecabinet.com/rules/WavingHands.html")
+    for line in HELP:
+        output(line)
+
+def menu_lines(menu_name: str, option_names: Tuple[str, ...]) -> List[str]:
+    return ["", "{}:".format(menu_name)] + ["{}) {}".format(i, name) for i, name in enumerate(option_names)]
 
 def menu(menu_name: str, options: Tuple[Tuple[str, Optional[Callable[[io.Input, io.Output], None]]], ...], get_input: io.Input, output: io.Output) -> None:
     while True:
-        output("")
-        output("{}:".format(menu_name))
-        for i in range(len(options)):
-            output("{}) {}".format(i, options[i][0]))
+        for line in menu_lines(menu_name, tuple(option[0] for option in options)):
+            output(line)
         command = io.get_int_input(range(len(options)), get_input, output)
         action = options[command][1]
         if action is None:
@@ -434,14 +598,73 @@ title = """\
  | |____| | | | (_| | |  __/\__ \__ \\
  |______|_| |_|\__,_|_|\___||___/___/"""
 
-def main(get_input: io.Input=io.get_input_from_stdin, output: io.Output=io.print_to_stdout) -> None:
-    output(title)
-    options = (
-        ("Play Game", play_game),
-        ("Help", show_help),
-        ("Quit", None),
+# # # STEPPING # # #
+
+# The game as a pure step function over GameState, one line of input at a time
+
+MAIN_MENU = "Main Menu"
+MAIN_MENU_OPTIONS = ("Play Game", "Help", "Quit")
+PLAYING = "Play Game"
+
+def start_game() -> Tuple[GameState, List[str]]:
+    return GameState(MAIN_MENU, load_npc("tomar"), load_location("starting_laboratory")), [title] + menu_lines(MAIN_MENU, MAIN_MENU_OPTIONS)
+
+def advance_game(state: GameState, speech: str) -> Tuple[Optional[GameState], List[str]]:
+    if state.screen == PLAYING:
+        tomar, location, outputs = play_turn(state.tomar, state.location, speech)
+        return state._replace(tomar=tomar, location=location), outputs
+    command, complaint = io.parse_int_choice(speech, range(len(MAIN_MENU_OPTIONS)))
+    if command is None:
+        return state, [complaint]
+    elif command == 0:
+        return state._replace(screen=PLAYING), GameSession(state.tomar, state.location).greet()
+    elif command == 1:
+        return state, list(HELP) + menu_lines(MAIN_MENU, MAIN_MENU_OPTIONS)
+    return None, []  # Quit
+
+def snapshot_game(state: GameState) -> GameSnapshot:
+    tomar = state.tomar
+    return GameSnapshot(
+        screen=state.screen,
+        seized_by_player=tomar.seized_by_player,
+        confusion=tomar.confusion,
+        impatience=tomar.impatience,
+        beliefs=tuple(sorted(BELIEFS.names(tomar.beliefs))),
+        statements_of_confusion=tomar.statements_of_confusion,
+        statements_of_impatience=tomar.statements_of_impatience,
+        cached_strategy=(STRATEGIES.node_name(tomar.cached_strategy)
+                         if tomar.cached_strategy is not None else None),
+        primary_control_system=(CONTROL_SYSTEM_NAMES[tomar.primary_control_system]
+                                if tomar.primary_control_system else None),
+        location=state.location,
     )
-    menu("Main Menu", options, get_input, output)
+
+def restore_game(snapshot: GameSnapshot) -> GameState:
+    load_npc("tomar")  # Strategy nodes are named in the graph compiled for Tomar
+    tomar = Mind(
+        seized_by_player=snapshot.seized_by_player,
+        confusion=snapshot.confusion,
+        impatience=snapshot.impatience,
+        beliefs=BELIEFS.mask(snapshot.beliefs),
+        statements_of_confusion=snapshot.statements_of_confusion,
+        statements_of_impatience=snapshot.statements_of_impatience,
+        cached_strategy=(STRATEGIES.node_named(snapshot.cached_strategy)
+                         if snapshot.cached_strategy is not None else None),
+        primary_control_system=(control_system(snapshot.primary_control_system)
+                                if snapshot.primary_control_system else None),
+    )
+    return GameState(snapshot.screen, tomar, Location(*snapshot.location))
+
+def main(get_input: io.Input=io.get_input_from_stdin, output: io.Output=io.print_to_stdout) -> None:
+    state: Optional[GameState]
+    state, lines = start_game()
+    while True:
+        for line in lines:
+            output(line)
+        if state is None:
+            return
+        state, lines = advance_game(state, get_input())
 
 if __name__ == "__main__":
-    main()
+    with io.BufferedOutput() as output:
+        main(output.wrap_input(io.get_input_from_stdin), output)
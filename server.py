@@ -0,0 +1,56 @@
+import asyncio
+import sys
+import traceback
+from typing import List
+
+import main
+
+# Serves one GameSession per connection on a local socket, all multiplexed on a single event loop.
+# The protocol is the same as the terminal: a line of speech in, the game's lines and a prompt out.
+
+PROMPT = "> "
+
+def render(lines: List[str]) -> bytes:
+    return ("".join(line + "\n" for line in lines) + PROMPT).encode()
+
+async def run_session(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+    session = main.GameSession()
+    writer.write(render(session.greet()))
+    try:
+        while True:
+            await writer.drain()
+            line = await reader.readline()
+            if not line:
+                break
+            speech = line.decode(errors="replace").rstrip("\r\n")
+            if speech == "":
+                writer.write(PROMPT.encode())
+                continue
+            try:
+                outputs = session.feed(speech)
+            except NotImplementedError:
+                writer.write(b"That part of the game isn't written yet. Goodbye.\n")
+                break
+            except Exception:
+                # The session can't be trusted after this, but the other sessions carry on
+                traceback.print_exc()
+                writer.write(b"Something went wrong in the game. Goodbye.\n")
+                break
+            writer.write(render(outputs))
+        await writer.drain()
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+        try:
+            await writer.wait_closed()
+        except ConnectionError:
+            pass
+
+async def serve(path: str) -> None:
+    server = await asyncio.start_unix_server(run_session, path=path)
+    async with server:
+        await server.serve_forever()
+
+if __name__ == "__main__":
+    asyncio.run(serve(sys.argv[1] if len(sys.argv) > 1 else "endless.sock"))
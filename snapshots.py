@@ -0,0 +1,266 @@
+from typing import Any, Dict, List, Mapping, Optional, Tuple
+from array import array
+
+import main
+import alice_in_antioch as antioch
+from archives import Archive, ArchiveError, Decoder, Encoder, write_archive
+
+# Saved game sessions and simulated worlds, as archives of records that are decoded only when they
+# are looked up, so a server can restore just the sessions that come back. Control systems,
+# strategy nodes, beliefs and planning allocators are stored by their stable names, never as
+# pickled functions, so snapshots survive restarts and new versions of the game.
+
+SESSIONS = 1  # Archive kinds
+WORLDS = 2
+
+# # # SESSIONS # # #
+
+def encode_session(encoder: Encoder, state: main.GameState) -> None:
+    snapshot = main.snapshot_game(state)
+    encoder.text(snapshot.screen)
+    encoder.uint(snapshot.seized_by_player)
+    encoder.uint(snapshot.confusion)
+    encoder.uint(snapshot.impatience)
+    encoder.sequence(snapshot.beliefs)
+    encoder.sequence(snapshot.statements_of_confusion)
+    encoder.sequence(snapshot.statements_of_impatience)
+    encoder.optional_text(snapshot.cached_strategy)
+    encoder.optional_text(snapshot.primary_control_system)
+    location = snapshot.location
+    encoder.sequence((location.name, location.perception, location.position))
+    encoder.sequence(location.nature)
+    encoder.sequence(location.foci)
+
+def decode_session(decoder: Decoder) -> main.GameState:
+    screen = decoder.text()
+    seized_by_player = bool(decoder.uint())
+    confusion = decoder.uint()
+    impatience = decoder.uint()
+    beliefs = decoder.texts()
+    statements_of_confusion = decoder.sequence()
+    statements_of_impatience = decoder.sequence()
+    cached_strategy = decoder.optional_text()
+    primary_control_system = decoder.optional_text()
+    name, perception, position = decoder.texts()
+    location = main.Location(name, perception, position, decoder.texts(), decoder.texts())
+    return main.restore_game(main.GameSnapshot(
+        screen, seized_by_player, confusion, impatience, beliefs, statements_of_confusion,
+        statements_of_impatience, cached_strategy, primary_control_system, location))
+
+def save_sessions(path: str, sessions: Mapping[str, main.GameState]) -> None:
+    write_archive(path, SESSIONS, sessions, encode_session)
+
+def open_sessions(path: str) -> Archive:
+    return Archive(path, SESSIONS, decode_session)
+
+# # # WORLDS # # #
+
+# A world is stored as a table of every object reachable from it (worlds, bodies, minds and what
+# they know), each referred to by its position in the table, so shared and cyclic references come
+# back as they were. Transposition tables and satisfaction totals are caches and come back empty,
+# executors come back as None, and a decision in the middle of being planned is started afresh: the
+# best policy found so far is dropped along with the search, so the restored mind plans again.
+
+ALLOCATORS = {"Search": antioch.Search, "UCB1Search": antioch.UCB1Search}
+ALLOCATOR_NAMES = {allocator: name for name, allocator in ALLOCATORS.items()}
+OBJECT_TYPES = (antioch.World, antioch.LocationGraph, antioch.Location, antioch.Body, antioch.Mind,
+                antioch.Goal, antioch.Action, antioch.Policy)  # Indexed by type tag
+
+class WorldEncoder(Encoder):
+    def __init__(self, strings: Dict[str, int], sequences: Dict[Tuple[Optional[str], ...], int]) -> None:
+        super().__init__(strings, sequences)
+        self.object_ids: Dict[int, int] = {}
+        self.objects: List[Any] = []
+
+    def add(self, value: Any) -> int:
+        if type(value) not in OBJECT_TYPES:
+            raise ArchiveError("Can't save {!r} of type {}".format(value, type(value).__name__))
+        if id(value) not in self.object_ids:
+            self.object_ids[id(value)] = len(self.objects)
+            self.objects.append(value)
+        return self.object_ids[id(value)]
+
+    def ref(self, value: Any) -> None:
+        # 0 for None, otherwise one more than the object's position in the table
+        self.uint(0 if value is None else self.add(value) + 1)
+
+    def refs(self, values: Any) -> None:
+        values = list(values)
+        self.uint(len(values))
+        for value in values:
+            self.ref(value)
+
+    def optional_uint(self, value: Optional[int]) -> None:
+        self.uint(0 if value is None else value + 1)
+
+    def optional_double(self, value: Optional[float]) -> None:
+        self.uint(0 if value is None else 1)
+        if value is not None:
+            self.double(value)
+
+def encode_object(encoder: WorldEncoder, value: Any) -> None:
+    if isinstance(value, antioch.World):
+        encoder.ref(value.main_character)
+        encoder.ref(value.graph)
+        encoder.refs(value.entities)
+        for node, fatigue in zip(value.locations, value.fatigue):
+            encoder.uint(node)
+            encoder.double(fatigue)
+    elif isinstance(value, antioch.LocationGraph):
+        encoder.refs(value.locations)
+        for neighbour in value.adjacency:
+            encoder.uint(neighbour + 1)
+    elif isinstance(value, antioch.Location):
+        encoder.text(value.name)
+    elif isinstance(value, antioch.Body):
+        encoder.ref(value.mind)
+        encoder.double(value.fatigue)
+    elif isinstance(value, antioch.Mind):
+        encoder.text(value.name)
+        encoder.refs(value.goals)
+        encoder.refs(value.possible_actions)
+        encoder.signed(value.internal_clock)
+        encoder.ref(value.policy if value.search is None else None)  # A provisional policy is planned again
+        encoder.refs(value.recent_policies)
+        encoder.ref(value.world_model)
+        encoder.ref(value.self_model)
+        encoder.signed(value.surprise_threshold)
+        encoder.uint(value.batch_rollouts)
+        encoder.uint(value.transposition_table.max_size)
+        encoder.uint(value.keep_transpositions)
+        encoder.uint(value.rollout_chunk_size)
+        encoder.uint(value.prune_hopeless)
+        encoder.uint(value.search_breadth)
+        encoder.uint(value.search_depth)
+        encoder.optional_double(value.time_budget)
+        encoder.optional_uint(value.rollout_budget)
+        encoder.text(ALLOCATOR_NAMES[value.allocator])
+        encoder.refs(value.samples_spent)
+        for samples in value.samples_spent.values():
+            encoder.uint(samples)
+    elif isinstance(value, antioch.Goal):
+        encoder.text(value.subject)
+        encoder.text(value.relation)
+        if isinstance(value.object, antioch.Location):
+            encoder.uint(1)
+            encoder.ref(value.object)
+        else:
+            encoder.uint(0)
+            encoder.text(value.object)
+    elif isinstance(value, antioch.Action):
+        encoder.text(value.summary)
+        encoder.text(value.present_tense)
+    elif isinstance(value, antioch.Policy):
+        encoder.refs(value.sequence)
+        encoder.signed(value.start_time)
+
+def encode_world(encoder: Encoder, world: Any) -> None:
+    # Objects are discovered while earlier ones are encoded, so their bodies are encoded into a
+    # separate buffer and the type tags of the finished table are written in front of them
+    objects = WorldEncoder(encoder.strings, encoder.sequences)
+    objects.add(world)
+    position = 0
+    while position < len(objects.objects):
+        encode_object(objects, objects.objects[position])
+        position += 1
+    encoder.uint(len(objects.objects))
+    encoder.buffer += bytes(OBJECT_TYPES.index(type(value)) for value in objects.objects)
+    encoder.buffer += objects.buffer
+
+class WorldDecoder(Decoder):
+    def __init__(self, decoder: Decoder, objects: List[Any]) -> None:
+        super().__init__(decoder.data, decoder.position, decoder.archive)
+        self.objects = objects
+
+    def ref(self) -> Any:
+        position = self.uint()
+        return None if position == 0 else self.objects[position - 1]
+
+    def refs(self) -> List[Any]:
+        return [self.ref() for _ in range(self.uint())]
+
+    def optional_uint(self) -> Optional[int]:
+        value = self.uint()
+        return None if value == 0 else value - 1
+
+    def optional_double(self) -> Optional[float]:
+        return self.double() if self.uint() else None
+
+def decode_object(decoder: WorldDecoder, value: Any) -> None:
+    # Fills in an object made with __new__, mirroring encode_object
+    if isinstance(value, antioch.World):
+        value.main_character = decoder.ref()
+        value.graph = decoder.ref()
+        value.entities = decoder.refs()
+        value.locations = antioch.Column("i")
+        value.fatigue = antioch.Column("d")
+        for _ in value.entities:
+            value.locations.append(decoder.uint())
+            value.fatigue.append(decoder.double())
+        value.changed = None
+        value.inherited = None
+        value.totals = {}
+    elif isinstance(value, antioch.LocationGraph):
+        value.locations = decoder.refs()
+        value.node_ids = {location: node for node, location in enumerate(value.locations)}
+        value.adjacency = array("i", [decoder.uint() - 1 for _ in range(len(value.locations) * len(value.directions))])
+        value.distances = None
+    elif isinstance(value, antioch.Location):
+        value.name = decoder.text()
+    elif isinstance(value, antioch.Body):
+        value.mind = decoder.ref()
+        value.fatigue = decoder.double()
+    elif isinstance(value, antioch.Mind):
+        value.name = decoder.text()
+        value.goals = set(decoder.refs())
+        value.possible_actions = set(decoder.refs())
+        value.internal_clock = decoder.signed()
+        value.policy = decoder.ref()
+        value.recent_policies = tuple(decoder.refs())
+        value.world_model = decoder.ref()
+        value.self_model = decoder.ref()
+        value.surprise_threshold = decoder.signed()
+        value.batch_rollouts = bool(decoder.uint())
+        value.transposition_table = antioch.TranspositionTable(decoder.uint())
+        value.keep_transpositions = bool(decoder.uint())
+        value.executor = None
+        value.rollout_chunk_size = decoder.uint()
+        value.prune_hopeless = bool(decoder.uint())
+        value.search_breadth = decoder.uint()
+        value.search_depth = decoder.uint()
+        value.time_budget = decoder.optional_double()
+        value.rollout_budget = decoder.optional_uint()
+        value.search = None
+        value.allocator = ALLOCATORS[decoder.text()]
+        policies = decoder.refs()
+        value.samples_spent = {policy: decoder.uint() for policy in policies}
+        value.compiled_goals = None
+    elif isinstance(value, antioch.Goal):
+        value.subject = decoder.text()
+        value.relation = decoder.text()
+        value.object = decoder.ref() if decoder.uint() else decoder.text()
+    elif isinstance(value, antioch.Action):
+        value.summary = decoder.text()
+        value.present_tense = decoder.text()
+    elif isinstance(value, antioch.Policy):
+        value.sequence = decoder.refs()
+        value.start_time = decoder.signed()
+
+def decode_world(decoder: Decoder) -> Any:
+    count = decoder.uint()
+    tags = decoder.data[decoder.position:decoder.position + count]
+    decoder.position += count
+    objects = [OBJECT_TYPES[tag].__new__(OBJECT_TYPES[tag]) for tag in tags]
+    objects_decoder = WorldDecoder(decoder, objects)
+    for value in objects:
+        decode_object(objects_decoder, value)
+    for value in objects:
+        if isinstance(value, antioch.World):  # Entities are named by their minds, so only now
+            value.entity_ids = {str(entity): entity_id for entity_id, entity in enumerate(value.entities)}
+    return objects[0]
+
+def save_worlds(path: str, worlds: Mapping[str, Any]) -> None:
+    write_archive(path, WORLDS, worlds, encode_world)
+
+def open_worlds(path: str) -> Archive:
+    return Archive(path, WORLDS, decode_world)
@@ -1,16 +1,45 @@
-from typing import Tuple, Generator, Callable, Union, List, Optional
+from typing import Any, Tuple, Generator, Callable, Dict, Iterable, Union, List, Optional
+import argparse
+import asyncio
+import contextlib
+import functools
+import io as io_module
 import itertools
+import json
+import multiprocessing
+import os
+import pickle
+import stat
+import subprocess
 import sys
+import tempfile
+import time
+import types
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from copy import deepcopy
 
 import main
+import archives
 import basic_io as io
+import benchmarks
+import content
+import instrumentation
+import journal
+import server
+import snapshots
+import alice_in_antioch as antioch
+
+# The game's content is compiled on first use. Its bundle goes in a cache of the tests' own rather
+# than the real one, and worker processes and subprocesses inherit the setting.
+TEST_CACHE = tempfile.TemporaryDirectory()
+os.environ["ENDLESS_CACHE_DIR"] = TEST_CACHE.name
 
 class EndOfTest(Exception):
     def __repr__(self) -> str:
         return "[END OF TEST]"
 
 class TestInputSource(object):
-    def __init__(self, feed: Tuple[str], output: io.Output) -> None:
+    def __init__(self, feed: Tuple[str, ...], output: io.Output) -> None:
         self.feed = feed
         self.output = output
         self.index = 0
@@ -32,7 +61,7 @@ class TestOutputBuffer(object):
             text = ""
         self.buffer += text.split('\n')
 
-def try_sequence(game: io.MainFunction, sequence: Tuple[str]) -> Tuple[Exception, List[str]]:
+def try_sequence(game: io.MainFunction, sequence: Tuple[str, ...]) -> Tuple[Exception, List[str]]:
     output_buffer = TestOutputBuffer()
     get_input = TestInputSource(sequence, output_buffer)
     try:
@@ -41,7 +70,7 @@ def try_sequence(game: io.MainFunction, sequence: Tuple[str]) -> Tuple[Exception
     except Exception as e:
         return e, output_buffer.buffer
 
-def _simple_test(game: io.MainFunction, sequence: Tuple[str], not_implemented_errors_are_okay: bool=False) -> None:
+def _simple_test(game: io.MainFunction, sequence: Tuple[str, ...], not_implemented_errors_are_okay: bool=False) -> None:
     result, log = try_sequence(game, sequence)
     if isinstance(result, EndOfTest):
         pass
@@ -53,24 +82,152 @@ def _simple_test(game: io.MainFunction, sequence: Tuple[str], not_implemented_er
         print(repr(result))
         raise result
 
-def _compare_test(original: io.MainFunction, refactor: io.MainFunction, sequence: Tuple[str]) -> None:
+def find_divergence(original: io.MainFunction, refactor: io.MainFunction, sequence: Tuple[str, ...]) -> Optional[Tuple[List[str], str, str]]:
+    # The lines both games agreed on and the first line where they differ, or None if they never do
     result1, log1 = try_sequence(original, sequence)
     result2, log2 = try_sequence(refactor, sequence)
     log1.append(repr(result1))
     log2.append(repr(result2))
-    if log1 == log2:
+    for i in range(max(len(log1), len(log2))):
+        line1 = log1[i] if i < len(log1) else ""
+        line2 = log2[i] if i < len(log2) else ""
+        if line1 != line2:
+            return log1[:i], line1, line2
+    return None
+
+def _compare_test(original: io.MainFunction, refactor: io.MainFunction, sequence: Tuple[str, ...]) -> None:
+    divergence = find_divergence(original, refactor, sequence)
+    if divergence is None:
+        pass
+    else:
+        shared, line1, line2 = divergence
+        for line in shared:
+            print(line)
+        print("###### DIVERGENCE! ######")
+        print("ORIGINAL:")
+        print("\t%s" % line1)
+        print("REFACTOR:")
+        print("\t%s" % line2)
+        raise Exception("Test divergence!")
+
+def step_game(game: Any, state: Any, speech: str) -> Tuple[Any, List[str]]:
+    # One step of a game module exposing advance_game, with a raised exception as its final line
+    try:
+        return game.advance_game(state, speech)
+    except Exception as e:
+        return None, [repr(e)]
+
+def compare_stepwise(original: Any, refactor: Any, inputs: Tuple[str, ...], depth: int) -> Optional[Tuple[Tuple[str, ...], List[str], List[str]]]:
+    # Steps two game modules side by side through every ordering of inputs up to depth. Both games are
+    # forked from the states they reached after each shared prefix rather than replayed, only the
+    # output of each step is compared, and the search stops at the first divergence, returning the
+    # sequence and the lines each game printed for its last step.
+    state1, lines1 = original.start_game()
+    state2, lines2 = refactor.start_game()
+    if lines1 != lines2:
+        return (), lines1, lines2
+    frontier: List[Tuple[Tuple[str, ...], Any, Any]] = [((), state1, state2)]
+    seen = {(original.snapshot_game(state1), refactor.snapshot_game(state2))}
+    for _ in range(depth):
+        next_frontier = []
+        for sequence, state1, state2 in frontier:
+            for speech in inputs:
+                next_state1, lines1 = step_game(original, state1, speech)
+                next_state2, lines2 = step_game(refactor, state2, speech)
+                if lines1 != lines2:
+                    return sequence + (speech,), lines1, lines2
+                if next_state1 is None or next_state2 is None:
+                    if next_state1 is not next_state2:
+                        return sequence + (speech,), lines1 + ["[GAME OVER]"], lines2 + ["[GAME OVER]"]
+                    continue
+                checkpoint = (original.snapshot_game(next_state1), refactor.snapshot_game(next_state2))
+                if checkpoint not in seen:
+                    seen.add(checkpoint)
+                    next_frontier.append((sequence + (speech,), next_state1, next_state2))
+        frontier = next_frontier
+    return None
+
+def _compare_stepwise_test(original: Any, refactor: Any, inputs: Tuple[str, ...], depth: int) -> None:
+    divergence = compare_stepwise(original, refactor, inputs, depth)
+    if divergence is None:
         pass
     else:
-        for i in range(max(len(log1), len(log2))):
-            if log1[i] == log2[i]:
-                print(log1[i])
-            else:
-                print("###### DIVERGENCE! ######")
-                print("ORIGINAL:")
-                print("\t%s" % log1[i])
-                print("REFACTOR:")
-                print("\t%s" % log2[i])
-                raise Exception("Test divergence!")
+        sequence, lines1, lines2 = divergence
+        print("> " + "\n> ".join(sequence))
+        print("###### DIVERGENCE! ######")
+        print("ORIGINAL:")
+        print("\t%s" % "\n\t".join(lines1))
+        print("REFACTOR:")
+        print("\t%s" % "\n\t".join(lines2))
+        raise Exception("Test divergence!")
+
+# Checks for run_sharded. Each takes (index, sequence) and returns the index with a failure report, or None.
+def check_sequence(game: io.MainFunction, not_implemented_errors_are_okay: bool, job: Tuple[int, Tuple[str, ...]]) -> Tuple[int, Optional[str]]:
+    # Failures are reported with only the inputs read before them, so every sequence sharing that
+    # prefix reports the same failure
+    index, sequence = job
+    get_input = TestInputSource(sequence, TestOutputBuffer())
+    try:
+        game(get_input, get_input.output)
+        return index, None
+    except EndOfTest:
+        return index, None
+    except NotImplementedError as e:
+        if not_implemented_errors_are_okay:
+            return index, None
+        result: Exception = e
+    except Exception as e:
+        result = e
+    return index, "{}: {}".format(sequence[:get_input.index], repr(result))
+
+def check_equivalence(original: io.MainFunction, refactor: io.MainFunction, job: Tuple[int, Tuple[str, ...]]) -> Tuple[int, Optional[str]]:
+    index, sequence = job
+    divergence = find_divergence(original, refactor, sequence)
+    if divergence is None:
+        return index, None
+    shared, line1, line2 = divergence
+    return index, "{}: diverges at line {}\nORIGINAL:\n\t{}\nREFACTOR:\n\t{}".format(sequence, len(shared), line1, line2)
+
+def run_sharded(check: Callable[[Tuple[int, Tuple[str, ...]]], Tuple[int, Optional[str]]],
+                sequences: Iterable[Tuple[str, ...]],
+                processes: Optional[int]=None,
+                report: io.Output=print,
+                shard_size: int=64) -> List[Tuple[int, str]]:
+    # Runs check on every sequence across a process pool, reporting each distinct failure as soon as
+    # it is first found. The failures are returned in order of the first sequence to cause them,
+    # however the shards happened to be scheduled.
+    failures: Dict[str, int] = {}
+    with multiprocessing.Pool(processes) as pool:
+        for index, failure in pool.imap_unordered(check, enumerate(sequences), shard_size):
+            if failure is not None:
+                if failure not in failures:
+                    report(failure)
+                    failures[failure] = index
+                failures[failure] = min(failures[failure], index)
+    return sorted((index, failure) for failure, index in failures.items())
+
+def explore_states(inputs: Tuple[str, ...], depth: int) -> Tuple[int, Dict[Tuple[str, str], Tuple[str, ...]]]:
+    # Steps the game breadth-first through every ordering of inputs up to depth, branching from shared
+    # prefixes and visiting each distinct game state once. Returns how many states were reached and,
+    # for each distinct failure, the shortest input sequence that causes it.
+    start, _ = main.start_game()
+    paths: Dict[main.GameState, Tuple[str, ...]] = {start: ()}
+    frontier = [start]
+    failures: Dict[Tuple[str, str], Tuple[str, ...]] = {}
+    for _ in range(depth):
+        next_frontier = []
+        for state in frontier:
+            for speech in inputs:
+                try:
+                    next_state, _ = main.advance_game(state, speech)
+                except Exception as e:
+                    failures.setdefault((repr(e), speech), paths[state] + (speech,))
+                    continue
+                if next_state is not None and next_state not in paths:
+                    paths[next_state] = paths[state] + (speech,)
+                    next_frontier.append(next_state)
+        frontier = next_frontier
+    return len(paths), failures
 
 # The type signature for this test generator is an absolute monster. Ignore it.
 def test_input_combinations():  # type: ignore
@@ -79,6 +236,9 @@ def test_input_combinations():  # type: ignore
     comparison_testing = False
     if comparison_testing:
         import main2
+        if hasattr(main2, 'advance_game'):
+            yield _compare_stepwise_test, main, main2, tuple(input_set), sequence_length  # type: ignore
+            return
         for x in itertools.combinations_with_replacement(input_set, sequence_length):
             yield _compare_test, main.main, main2.main, x  # type: ignore
     else:
@@ -86,5 +246,718 @@ def test_input_combinations():  # type: ignore
         for x in itertools.combinations_with_replacement(input_set, sequence_length):
             yield _simple_test, main.main, x, not_implemented_errors_are_okay  # type: ignore
 
+def test_belief_registry_round_trips() -> None:
+    registry = main.BeliefRegistry()
+    beliefs = registry.mask(["the sky is blue", "water is wet"])
+    assert registry.holds(beliefs, "water is wet") and not registry.holds(beliefs, "fire is cold")
+    assert registry.names(beliefs | registry.bit("fire is cold")) == {"the sky is blue", "water is wet", "fire is cold"}
+
+def test_strategy_graph_follows_forks() -> None:
+    graph = main.StrategyGraph()
+    root = graph.compile(main.strategy("test_binding"))
+    confused = main.TOMAR._replace(beliefs=main.TOMAR.beliefs | main.BINDING_HAS_PROBLEMS)
+    calm = graph.advance(root, main.TOMAR)
+    worried = graph.advance(root, confused)
+    assert graph.active[root] is main.control_system("wait_for_master_to_cast_a_spell")
+    assert calm is not None and graph.active[calm] is main.control_system("ask_about_starting_tests")
+    assert worried is not None and graph.active[worried] is main.control_system("check_for_objection_to_begin_tests")
+    assert len(graph.active) == 5  # The shared test_master branch is only compiled once
+
+def test_spell_descriptions_are_rendered_once() -> None:
+    location = main.STARTING_LABORATORY._replace(name="Copy of the laboratory")
+    description = main.spell__shta(location)
+    assert main.spell__shta(main.Location(*location)) is description
+    assert "|Foci: None" in description
+    _, seized = main.spell_shak(main.TOMAR, location)
+    assert main.spell_shak(main.TOMAR, location)[1] is seized
+    details = main.ConfusionDetails(("a", "b", "c"), "Why?")
+    assert main.render_confusion("{explanation} {suggestions[1]}", details) == "Why? b"
+    hits = main.render_confusion.cache_info().hits
+    main.render_confusion("{explanation} {suggestions[1]}", details)
+    assert main.render_confusion.cache_info().hits == hits + 1
+
+def test_game_session_matches_play_game() -> None:
+    sequence = ('shta', 'xyzzy', 'shak', 'shak', 'shta')
+    _, log = try_sequence(main.play_game, sequence)
+    session = main.GameSession()
+    transcript = session.greet()
+    for speech in sequence:
+        transcript += ["> " + speech] + session.feed(speech)
+    assert '\n'.join(transcript).split('\n') == log
+
+def test_server_runs_concurrent_sessions() -> None:
+    async def talk(path: str, speech: str) -> bytes:
+        reader, writer = await asyncio.open_unix_connection(path)
+        await reader.readuntil(server.PROMPT.encode())
+        writer.write(speech.encode() + b"\n")
+        reply = await reader.readuntil(server.PROMPT.encode())
+        writer.write_eof()
+        assert await reader.read() == b""
+        writer.close()
+        await writer.wait_closed()
+        return reply
+
+    async def scenario(path: str) -> List[bytes]:
+        listener = await asyncio.start_unix_server(server.run_session, path=path)
+        async with listener:
+            return list(await asyncio.gather(talk(path, "shta"), talk(path, "shak")))
+
+    with tempfile.TemporaryDirectory() as directory:
+        looked, seized = asyncio.run(scenario(os.path.join(directory, "endless.sock")))
+    assert looked.startswith(b"+--\n|Perception: I'm in Master's laboratory.")
+    assert b"Tomar's mind yields before your power." in seized
+
+def test_server_reports_game_errors_to_the_client() -> None:
+    def broken(self: main.GameSession, speech: str) -> List[str]:
+        raise KeyError(speech)
+
+    async def scenario(path: str) -> bytes:
+        listener = await asyncio.start_unix_server(server.run_session, path=path)
+        async with listener:
+            reader, writer = await asyncio.open_unix_connection(path)
+            await reader.readuntil(server.PROMPT.encode())
+            writer.write(b"shta\n")
+            reply = await reader.read()
+            writer.close()
+            await writer.wait_closed()
+            return reply
+
+    feed = main.GameSession.feed
+    main.GameSession.feed = broken  # type: ignore
+    try:
+        with tempfile.TemporaryDirectory() as directory, contextlib.redirect_stderr(io_module.StringIO()):
+            reply = asyncio.run(scenario(os.path.join(directory, "endless.sock")))
+    finally:
+        main.GameSession.feed = feed  # type: ignore
+    assert reply == b"Something went wrong in the game. Goodbye.\n"
+
+def test_world_step_is_persistent() -> None:
+    world = antioch.World()
+    desert = antioch.Location("in the desert")
+    city = antioch.Location("in Antioch")
+    world.graph.connect(desert, "north", city)
+    alice = antioch.Body(antioch.Mind("Alice"))
+    world.insert_entity(alice, desert)
+    walked = world.step({"Alice": antioch.Action("go north", "goes north")})
+    waited = walked.step({"Alice": antioch.Action("wait", "waits")})
+    assert world.location_of("Alice") is desert and world.get_entity("Alice").fatigue == 0
+    assert walked.location_of("Alice") is city and walked.get_entity("Alice").fatigue == 0.1
+    assert waited.get_entity("Alice").fatigue == 0.1 and waited.entities is world.entities
+    assert walked.get_entity("Alice").mind is alice.mind
+
+def test_world_step_copies_only_the_chunks_it_changes() -> None:
+    world, _ = benchmarks.alice_world(1, 1000)
+    walked = world.step({"Alice": antioch.Action("go north", "goes north")})
+    alice = world.entity_ids["Alice"]
+    shared = [after for before, after in zip(world.fatigue.chunks, walked.fatigue.chunks) if before is after]
+    assert len(shared) == len(world.fatigue.chunks) - 1 and walked.fatigue[alice] == world.fatigue[alice] + 0.1
+    assert list(world.fatigue) == [0.0] * 1000 and walked.changed == {"location": [alice], "fatigue": [alice]}
+    rested = walked.step({"Alice": antioch.Action("go east", "goes east")})
+    assert rested.fatigue[alice] == walked.fatigue[alice] + 0.1 and walked.fatigue[alice] == 0.1
+
+def test_world_tick_moves_every_entity() -> None:
+    world = antioch.World()
+    desert = antioch.Location("in the desert")
+    city = antioch.Location("in Antioch")
+    world.graph.connect(desert, "north", city)
+    for name in ("Alice", "Bob"):
+        mind = antioch.Mind(name)
+        mind.policy = antioch.Policy([antioch.Action("go north", "goes north")], 0)
+        world.insert_entity(antioch.Body(mind), desert)
+    world = world.tick()
+    assert world.location_of("Alice") is city and world.location_of("Bob") is city
+    assert world.attribute_of("Bob", "fatigue") == 0.1
+
+def test_location_graph_distances() -> None:
+    graph = antioch.LocationGraph()
+    desert, city, coast, island = (antioch.Location(name) for name in ("desert", "city", "coast", "island"))
+    graph.connect(desert, "north", city)
+    graph.connect(city, "west", coast)
+    graph.add(island)
+    assert graph.distance(graph.add(desert), graph.add(coast)) == 2
+    assert graph.distance(graph.add(coast), graph.add(desert)) == 2
+    assert graph.distance_to_any(graph.add(desert), graph.nodes_named("island")) == graph.unreachable
+    assert graph.distance_to_any(graph.add(desert), graph.nodes_named("coast") + graph.nodes_named("city")) == 1
+
+def test_pruning_hopeless_rollouts_keeps_the_best_score() -> None:
+    mind = benchmarks.alice_mind(("wait", "go north", "go south", "go east"))
+    city = antioch.Location("in Antioch")
+    mind.world_model.graph.add(city)  # Out of reach
+    mind.goals.add(antioch.Goal("Alice", "is in", city))
+    policies = mind.generate_possible_policies()
+    exact = mind.imagine_all(mind.world_model, policies, 10)
+    mind.prune_hopeless = True
+    mind.transposition_table.clear()
+    pruned = mind.imagine_all(mind.world_model, policies, 10)
+    assert None in pruned and max([score for score in pruned if score is not None]) == max(exact)
+
+def test_anytime_planning_spreads_a_decision_over_acts() -> None:
+    mind = benchmarks.alice_mind(("wait", "go east"))
+    mind.search_breadth = 40
+    mind.rollout_budget = 10
+    for _ in range(3):
+        assert mind.act(antioch.Sensation()) is not None and mind.search is not None
+    assert mind.act(antioch.Sensation()).summary == "wait" and mind.search is None
+    assert list(mind.recent_policies) == [mind.policy]
+    mind.policy = None
+    mind.time_budget = 0  # Already out of time, but a round of the candidates still runs
+    mind.act(antioch.Sensation())
+    search: Any = mind.search
+    assert search.done == len(search.policies) and search.score_estimates[mind.policy][0] == 1
+    mind.rollout_budget = 0
+    try:
+        mind.act(antioch.Sensation())
+        assert False
+    except ValueError:
+        pass
+
+def test_anytime_planning_scores_plans_from_when_the_decision_started() -> None:
+    scores: Dict[str, List[float]] = {}
+    class RecordingMind(antioch.Mind):
+        __slots__ = ()
+        def imagine(self, world_model, policy, search_depth, cutoff=None):  # type: ignore
+            score = super().imagine(world_model, policy, search_depth, cutoff)
+            scores.setdefault(repr(policy), []).append(score)
+            return score
+    def decide(rollout_budget: Optional[int]) -> Dict[str, List[float]]:
+        scores.clear()
+        mind = benchmarks.alice_mind(("wait", "go north", "go east"), city_to_the_north=True, mind_type=RecordingMind)
+        mind.search_breadth = 45
+        mind.rollout_budget = rollout_budget
+        with contextlib.redirect_stdout(io_module.StringIO()):
+            mind.act(antioch.Sensation())
+            while mind.search is not None:
+                mind.act(antioch.Sensation())
+        return dict(scores)
+    spread = decide(3)
+    assert spread == decide(None)
+    assert all(len(samples) == 1 for samples in spread.values())  # Known scores outlast each act
+
+def test_ucb1_search_concentrates_samples_on_the_leader() -> None:
+    mind = benchmarks.alice_mind(("wait", "go east"))
+    mind.allocator = antioch.UCB1Search
+    mind.search_breadth = 100
+    assert mind.act(antioch.Sensation()).summary == "wait"
+    samples = sorted(mind.samples_spent.items(), key=lambda item: item[1])
+    assert sum(mind.samples_spent.values()) == 100
+    assert repr(samples[-1][0]) == "Wait then wait" and samples[-1][1] > 50
+
+def test_batch_rollouts_match_serial_rollouts() -> None:
+    if antioch.numpy is None:
+        return
+    mind = benchmarks.alice_mind(("wait", "go north", "go east"), city_to_the_north=True)
+    policies = mind.generate_possible_policies()
+    serial = [mind.imagine(mind.world_model, policy, 10) for policy in policies]
+    assert mind.imagine_batch(mind.world_model, policies, 10) == serial
+
+def test_goal_satisfaction_is_tracked_incrementally() -> None:
+    evaluated = []
+    class CountingGoal(antioch.Goal):
+        __slots__ = ()
+        def evaluate(self, world_model, entity_id):  # type: ignore
+            evaluated.append(self.subject)
+            return super().evaluate(world_model, entity_id)
+    world, alice = benchmarks.alice_world(5, 4)
+    mind = antioch.Mind("Observer")
+    for name in world.entity_ids:
+        mind.goals.add(CountingGoal(name, "is in", world.graph.locations[0]))
+        mind.goals.add(CountingGoal(name, "has low", "fatigue"))
+    fresh = lambda world: sum([goal.satisfaction(world) for goal in mind.goals])
+    total = mind.satisfaction(world)
+    assert len(evaluated) == 8 and total == fresh(world)
+    for summary in ("go north", "wait", "go west", "go south"):
+        del evaluated[:]
+        world = world.step({"Alice": antioch.Action(summary, summary)})
+        assert mind.satisfaction(world) == mind.satisfaction(world)
+        assert set(evaluated) <= {"Alice"} and len(evaluated) == world.changed["location"].count(0) + world.changed["fatigue"].count(0)
+        assert mind.satisfaction(world) == fresh(world)
+    mind.goals.pop()
+    assert mind.satisfaction(world) == fresh(world)  # Changed goals are compiled afresh
+
+def test_deterministic_rollouts_are_simulated_once() -> None:
+    simulated = []
+    class CountingMind(antioch.Mind):
+        __slots__ = ()
+        def imagine(self, world_model, policy, search_depth, cutoff=None):  # type: ignore
+            simulated.append(policy)
+            return super().imagine(world_model, policy, search_depth, cutoff)
+    mind = benchmarks.alice_mind(mind_type=CountingMind)
+    wait = antioch.Policy([antioch.Action("wait", "waits")], 0)
+    walk = antioch.Policy([antioch.Action("go east", "goes east")], 0)
+    imagine = functools.partial(antioch.Mind.imagine, mind)
+    scores = mind.imagine_all(mind.world_model, [wait, walk] * 5, 10)
+    assert simulated == [wait, walk]
+    assert scores == [imagine(mind.world_model, wait, 10), imagine(mind.world_model, walk, 10)] * 5
+
+def test_transposition_table_does_not_change_scores() -> None:
+    mind = benchmarks.alice_mind(("wait", "go east", "go west"))
+    policies = mind.generate_possible_policies()
+    mind.transposition_table = antioch.TranspositionTable(0)
+    uncached = [mind.imagine(mind.world_model, policy, 10) for policy in policies]
+    mind.transposition_table = antioch.TranspositionTable(1000)
+    assert [mind.imagine(mind.world_model, policy, 10) for policy in policies] == uncached
+    assert len(mind.transposition_table) > 0
+
+def test_transposition_keys_ignore_what_goals_dont_depend_on() -> None:
+    world, alice = benchmarks.alice_world(5, 200)
+    goals = alice.mind.compile_goals(world)
+    actor = world.entity_ids["Alice"]
+    key = goals.state_key(world, actor)
+    moved = world.step({"Bystander 7": antioch.Action("go north", "goes north")})
+    assert moved.state_key() != world.state_key() and goals.state_key(moved, actor) == key
+    walked = world.step({"Alice": antioch.Action("go north", "goes north")})
+    assert goals.state_key(walked, actor) != key and len(key[2]) == 2
+
+def test_parallel_rollouts_match_serial_rollouts() -> None:
+    mind = benchmarks.alice_mind(("wait", "go east", "go west"))
+    policies = mind.generate_possible_policies() * 3
+    serial = mind.imagine_all(mind.world_model, policies, 10)
+    memoized = len(mind.transposition_table)
+    task = pickle.dumps(mind.rollouts(mind.world_model, None))
+    assert memoized > 0 and len(task) * 4 < len(pickle.dumps(mind))  # Tasks aren't sent the mind's table
+    for executor in (ThreadPoolExecutor(2), ProcessPoolExecutor(2)):
+        with executor:
+            mind.executor = executor
+            assert mind.imagine_all(mind.world_model, policies, 10) == serial
+    assert len(mind.transposition_table) == memoized  # Nor do threads share it
+
+def test_process_pools_are_not_slower_than_serial_rollouts() -> None:
+    # Each worker is sent the world once per decision, without the entities' minds, so even on a
+    # single core a pool only adds a small fixed cost to the rollouts themselves
+    world, alice = benchmarks.alice_world(7, 1000)
+    mind = alice.mind
+    policies = mind.generate_possible_policies()
+
+    def timed() -> Tuple[float, List[float]]:
+        mind.transposition_table.clear()
+        start = time.perf_counter()
+        scores = mind.imagine_all(world, policies, 100)
+        return time.perf_counter() - start, scores
+
+    serial, serial_scores = min(timed() for _ in range(2))
+    with ProcessPoolExecutor(2) as executor:
+        mind.executor = executor
+        mind.imagine_all(world, policies[:1], 1)  # Start the workers
+        pooled, scores = min(timed() for _ in range(2))
+    mind.executor = None
+    assert scores == serial_scores and pooled < serial * 1.5
+
+def test_world_copies_share_immutable_parts() -> None:
+    world, alice = benchmarks.alice_world(5, 3)
+    for record in (alice, alice.mind, world.graph.locations[0], next(iter(alice.mind.goals)), next(iter(alice.mind.possible_actions))):
+        assert not hasattr(record, "__dict__")
+    copied = deepcopy(world)
+    copied_alice = copied.get_entity("Alice")
+    assert copied_alice is not alice and copied_alice.mind is not alice.mind
+    assert copied_alice.mind.goals == alice.mind.goals and copied_alice.mind.possible_actions == alice.mind.possible_actions
+    assert copied.graph.locations == world.graph.locations
+    alice.mind.executor = ThreadPoolExecutor(1)
+    try:
+        unpickled = pickle.loads(pickle.dumps(alice.mind))
+    finally:
+        alice.mind.executor.shutdown()
+    assert unpickled.executor is None and unpickled.name == "Alice" and unpickled.search_depth == alice.mind.search_depth
+
+def test_session_archives_round_trip() -> None:
+    sessions: Dict[str, main.GameState] = {}
+    state: Optional[main.GameState]
+    state, _ = main.start_game()
+    for i, speech in enumerate(('1', '0', 'shta', 'nonsense', 'shak', 'nonsense', 'shak', 'shta', 'nonsense')):
+        assert state is not None
+        state, _ = main.advance_game(state, speech)
+        assert state is not None
+        sessions["session {}".format(i)] = state
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "sessions.snap")
+        snapshots.save_sessions(path, sessions)
+        with snapshots.open_sessions(path) as archive:
+            assert sorted(archive) == sorted(sessions) and len(archive) == len(sessions)
+            for key in reversed(list(sessions)):
+                assert archive[key] == sessions[key]
+        with open(path, "rb") as f:
+            contents = f.read()
+        with open(path, "r+b") as f:
+            f.seek(8)
+            f.write(b"\x09\x00")
+        try:
+            snapshots.open_sessions(path)
+            assert False
+        except archives.ArchiveError:
+            pass
+        for length in (0, 8, len(contents) // 2, len(contents) - 1):
+            with open(path, "wb") as f:
+                f.write(contents[:length])
+            try:
+                snapshots.open_sessions(path)
+                assert False
+            except archives.ArchiveError:
+                pass
+
+def test_world_archives_round_trip() -> None:
+    world, alice = benchmarks.alice_world(5, 3)
+    alice.mind.allocator = antioch.UCB1Search
+    alice.mind.rollout_budget = 30
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "worlds.snap")
+        snapshots.save_worlds(path, {"start": world})
+        with snapshots.open_worlds(path) as archive:
+            restored = archive["start"]
+    assert restored.state_key() == world.state_key()
+    restored_alice = restored.get_entity("Alice")
+    assert restored_alice.mind.self_model.mind is restored_alice.mind
+    assert restored_alice.mind.allocator is antioch.UCB1Search and restored_alice.mind.rollout_budget == 30
+    assert sorted(str(goal.object) for goal in restored_alice.mind.goals) == sorted(str(goal.object) for goal in alice.mind.goals)
+    for _ in range(3):
+        world = world.step({"Alice": alice.act(world)})
+        restored = restored.step({"Alice": restored_alice.act(restored)})
+        alice, restored_alice = world.get_entity("Alice"), restored.get_entity("Alice")
+        assert restored.state_key() == world.state_key()
+
+def test_world_archives_restart_decisions_saved_mid_plan() -> None:
+    world, alice = benchmarks.alice_world(5, 1)
+    alice.mind.search_breadth = 100
+    alice.mind.rollout_budget = 10
+    world = world.step({"Alice": alice.act(world)})
+    alice = world.get_entity("Alice")
+    assert alice.mind.search is not None and alice.mind.policy is not None
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "worlds.snap")
+        snapshots.save_worlds(path, {"planning": world})
+        with snapshots.open_worlds(path) as archive:
+            restored = archive["planning"]
+    restored_alice = restored.get_entity("Alice")
+    assert restored_alice.mind.policy is None and restored_alice.mind.search is None
+    for _ in range(12):
+        world = world.step({"Alice": alice.act(world)})
+        restored = restored.step({"Alice": restored_alice.act(restored)})
+        alice, restored_alice = world.get_entity("Alice"), restored.get_entity("Alice")
+    assert alice.mind.search is None and restored_alice.mind.search is None
+    assert repr(restored_alice.mind.recent_policies[-1]) == repr(alice.mind.recent_policies[-1])
+
+def test_journal_recovers_sessions_after_a_crash() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        store = journal.SessionStore(directory, snapshot_every=20, batch_size=4)
+        sequences = {"one": ('0', 'shta', 'shak', 'nonsense'), "two": ('1', '0', 'nonsense', 'shta', 'shak', 'shta'),
+                     "three": ('0', 'nonsense') * 4, "four": ('2',)}
+        for session, sequence in sequences.items():
+            store.start(session)
+            for speech in sequence:
+                store.feed(session, speech)
+        store.journal.sync()
+        assert store.generation == 1 and store.events_since_snapshot == len(sequences) + sum(map(len, sequences.values())) - 20
+        expected = store.sessions()
+        assert sorted(expected) == ["one", "three", "two"]
+        with open(journal.journal_path(directory, store.generation), "ab") as f:
+            f.write(journal.encode_event(journal.SPEECH, "one", "shta")[:-2])  # Torn by the crash
+
+        recovered = journal.SessionStore(directory, snapshot_every=20)
+        assert recovered.replayed == store.events_since_snapshot
+        assert recovered.sessions() == expected
+        lines = recovered.feed("one", "shta")
+        recovered.close()
+        assert lines == main.advance_game(expected["one"], "shta")[1]
+        again = journal.SessionStore(directory)
+        assert again.get("one") == recovered.get("one") and again.get("two") == expected["two"]
+        again.close()
+
+def test_journal_checkpoints_sync_their_directory() -> None:
+    events: List[str] = []
+    fsync, replace, remove = os.fsync, os.replace, os.remove
+
+    def traced_fsync(fd: int) -> None:
+        events.append("sync directory" if stat.S_ISDIR(os.fstat(fd).st_mode) else "sync file")
+        fsync(fd)
+
+    def traced(name: str, function: Any) -> Any:
+        def wrapper(*args: Any) -> Any:
+            events.append(name)
+            return function(*args)
+        return wrapper
+
+    with tempfile.TemporaryDirectory() as directory:
+        store = journal.SessionStore(directory, snapshot_every=2, batch_size=1)
+        store.start("one")
+        os.fsync, os.replace, os.remove = traced_fsync, traced("replace", replace), traced("remove", remove)  # type: ignore
+        try:
+            store.feed("one", "0")
+        finally:
+            os.fsync, os.replace, os.remove = fsync, replace, remove  # type: ignore
+        store.close()
+    assert store.generation == 1 and "replace" in events and "remove" in events
+    for operation in ("replace", "remove"):
+        last = len(events) - 1 - events[::-1].index(operation)
+        assert "sync directory" in events[last:]
+
+def test_content_compiles_to_a_lazy_bundle() -> None:
+    npc = {"strategy": {"active": "wait", "fork": [{"if": {"believes": "it is time"}, "then": "ask"}], "fallback": "ask"},
+           "statements_of_confusion": ["What?", None], "statements_of_impatience": [None]}
+    source: Dict[str, Any] = {
+        "locations": {"hall": {"name": "Hall", "perception": "A hall.", "position": "Here", "nature": ["Stone"]}},
+        "control_systems": {
+            "wait": {"is_satisfied": {"believes": "it is time"}, "say_on_progress": {"say": "Now."}},
+            "ask": {"is_satisfied": {"any": [{"believes": "it is time"}, {"impatience_above": 1}]},
+                    "say_on_progress": {"say": "Now."}, "say_on_return_without_progress": {"call": "give_hint_for_first_test"}},
+        },
+        "strategies": {"ask": {"active": "ask", "onward": None}},
+        "npcs": {"first": npc, "second": npc},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "game.json")
+        with open(path, "w") as f:
+            json.dump(source, f)
+        bundle_path = os.path.join(directory, "game.bundle")
+        bundle = content.load(path, bundle_path)
+        assert bundle.path == bundle_path
+        assert sorted(bundle.keys("npc")) == ["first", "second"] and bundle.npc("first").strategy == bundle.npc("second").strategy
+        assert sorted(bundle.keys("predicate")) == ["0", "1", "2"]  # "it is time" is compiled once
+        assert sorted(bundle.keys("response")) == ["0", "1"]
+        assert bundle.location("hall").foci == () and bundle.location("hall").nature == ("Stone",)
+        wait = bundle.strategy_node(bundle.npc("first").strategy)
+        assert [target for _, target in wait.transitions] == [bundle.strategy("ask")] * 2
+        bundle.close()
+
+        assert content.load(path, bundle_path).source().size == os.path.getsize(path)
+        source["npcs"]["third"] = npc
+        with open(path, "w") as f:
+            json.dump(source, f)
+        assert "third" in content.load(path, bundle_path).keys("npc")  # Stale bundles are rebuilt
+        source["npcs"]["third"] = {"strategy": "missing"}
+        with open(path, "w") as f:
+            json.dump(source, f)
+        try:
+            content.load(path, bundle_path)
+            assert False
+        except content.ContentError as e:
+            assert "npcs.third.strategy" in str(e)
+        del source["npcs"]["third"]
+        source["control_systems"]["wait"]["confusion_details"] = {"suggestions": ["Wait."]}
+        with open(path, "w") as f:
+            json.dump(source, f)
+        try:
+            content.load(path, bundle_path)
+            assert False
+        except content.ContentError as e:
+            assert "control_systems.wait.confusion_details.explanation" in str(e)
+        del source["control_systems"]["wait"]["confusion_details"]
+        for predicate in ({"impatience_above": 1, "holds": False}, {"any": [True], "holds": False}):
+            source["control_systems"]["wait"]["is_satisfied"] = predicate
+            with open(path, "w") as f:
+                json.dump(source, f)
+            try:
+                content.load(path, bundle_path)
+                assert False
+            except content.ContentError as e:
+                assert "control_systems.wait.is_satisfied.holds" in str(e)
+
+def test_content_strategies_can_lead_back_to_themselves() -> None:
+    source = {
+        "control_systems": {"wait": {"is_satisfied": {"believes": "it is time"}, "say_on_progress": {"say": "Now."}}},
+        "strategies": {"loop": {"active": "wait", "onward": "loop"}},
+    }
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "game.json")
+        with open(path, "w") as f:
+            json.dump(source, f)
+        environment = dict(os.environ, ENDLESS_CACHE_DIR=os.path.join(directory, "cache"))
+        script = ("import main, sys; main.CONTENT_SOURCE = sys.argv[1]; loop = main.strategy('loop'); "
+                  "print(loop.onward is loop, main.STRATEGIES.compile(loop))")
+        completed = subprocess.run([sys.executable, "-c", script, path], env=environment,
+                                   cwd=os.path.dirname(os.path.abspath(main.__file__)), stdout=subprocess.PIPE, check=True)
+    assert completed.stdout == b"True 0\n"
+
+def test_content_is_compiled_into_the_cache_on_first_use() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        environment = dict(os.environ, ENDLESS_CACHE_DIR=os.path.join(directory, "cache"))
+        script = "import main; import os; assert not os.path.exists(os.environ['ENDLESS_CACHE_DIR']); print(main.TOMAR.confusion)"
+        completed = subprocess.run([sys.executable, "-c", script], env=environment, cwd=os.path.dirname(os.path.abspath(main.__file__)),
+                                   stdout=subprocess.PIPE, check=True)
+        assert completed.stdout == b"0\n"
+        bundles = os.listdir(os.path.join(directory, "cache"))
+        assert len(bundles) == 1 and bundles[0].startswith("endless-") and bundles[0].endswith(".bundle")
+    assert not os.path.exists(os.path.join(os.path.dirname(main.CONTENT_SOURCE), "endless.bundle"))
+
+def test_input_permutations():  # type: ignore
+    input_set = ('0', 'shta', 'shak', 'chai', 'reho', '2', '1', 'nonsense')
+    sequence_length = 12
+    not_implemented_errors_are_okay = True  # chai and reho aren't written yet; anything else must not fail
+    _, failures = explore_states(input_set, sequence_length)
+    for sequence in sorted(failures.values()):
+        yield _simple_test, main.main, sequence, not_implemented_errors_are_okay  # type: ignore
+
+def test_snapshots_round_trip() -> None:
+    state: Optional[main.GameState]
+    state, _ = main.start_game()
+    for speech in ('nonsense', '0', 'nonsense', 'shta', 'shak', 'nonsense', 'shak', 'shta'):
+        assert state is not None
+        snapshot = pickle.loads(pickle.dumps(main.snapshot_game(state)))
+        assert main.restore_game(snapshot) == state
+        state, _ = main.advance_game(state, speech)
+
+def test_stepwise_comparison_finds_first_divergence() -> None:
+    def advance_game(state: main.GameState, speech: str) -> Tuple[Optional[main.GameState], List[str]]:
+        next_state, lines = main.advance_game(state, speech)
+        if speech == 'shak' and state.tomar.confusion > 1:
+            lines = lines[:-1]
+        return next_state, lines
+    refactor = types.SimpleNamespace(start_game=main.start_game, advance_game=advance_game, snapshot_game=main.snapshot_game)
+    inputs = ('0', 'nonsense', 'shak')
+    assert compare_stepwise(main, main, inputs, 6) is None
+    divergence = compare_stepwise(main, refactor, inputs, 6)
+    assert divergence is not None and divergence[0] == ('0', '0', '0', 'shak')
+
+def test_sharded_runs_match_serial_runs() -> None:
+    sequences = list(itertools.product(('0', 'shta', 'chai', '2'), repeat=4))
+    check = functools.partial(check_sequence, main.main, False)
+    serial = [check(job) for job in enumerate(sequences)]
+    first_failures: Dict[str, int] = {}
+    for index, failure in serial:
+        if failure is not None:
+            first_failures.setdefault(failure, index)
+    expected = sorted((index, failure) for failure, index in first_failures.items())
+    assert expected and run_sharded(check, sequences, 2, lambda text: None, 8) == expected
+    assert len(expected) < len([failure for _, failure in serial if failure is not None])  # Shared prefixes fail once
+    assert run_sharded(functools.partial(check_sequence, main.main, True), sequences, 2, lambda text: None, 8) == []
+
+def test_benchmarks_report_and_compare() -> None:
+    results = {name: benchmarks.measure(benchmark, 3) for name, benchmark in benchmarks.suite(quick=True).items()
+               if name.startswith("entity_turn/") or name == "world_step/entities=100"}
+    for summary in results.values():
+        assert summary["calls"] == 3 and summary["min_s"] <= summary["p50_s"] <= summary["p99_s"] <= summary["max_s"]
+    assert benchmarks.compare(results, results, 0.1) == []
+    slower = {name: dict(summary, p50_s=summary["p50_s"] * 2) for name, summary in results.items()}
+    assert len(benchmarks.compare(results, slower, 0.1)) == len(results)
+
+def test_instrumentation_times_phases_and_restores_functions() -> None:
+    original_turn = main.entity_turn
+    original_act = antioch.Mind.act
+    sink = instrumentation.MemorySink()
+    with instrumentation.Instrumentation(sink):
+        assert main.entity_turn is not original_turn
+        tomar = main.TOMAR
+        for speech in ('hello', 'shta', 'nonsense', 'shak'):
+            tomar, _, _ = main.entity_turn(tomar, main.STARTING_LABORATORY, speech)
+        world, alice = benchmarks.alice_world(5, 1)
+        alice.mind.search_breadth = 50
+        alice.mind.search_depth = 3
+        alice.act(world)
+    assert main.entity_turn is original_turn and antioch.Mind.act is original_act
+    assert sink.phases["entity_turn"].calls == 4
+    assert sink.phases["entity_turn.parse_intent"].calls == 4
+    assert sink.phases["mind_act"].calls == 1
+    assert sink.phases["mind_act.world_step"].calls == sink.phases["mind_act.goal_scoring"].calls > 0
+    assert sink.phases["entity_turn"].seconds >= sink.phases["entity_turn.parse_intent"].seconds
+
+def test_instrumentation_sinks_export() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        prometheus = instrumentation.PrometheusSink(os.path.join(directory, "endless.prom"))
+        with open(os.path.join(directory, "phases.jsonl"), "w") as stream:
+            json_lines = instrumentation.JsonLinesSink(stream, batch_size=2)
+            for sink in (prometheus, json_lines):
+                with instrumentation.Instrumentation(sink):
+                    main.entity_turn(main.TOMAR, main.STARTING_LABORATORY, 'shta')
+        with open(prometheus.path) as f:
+            exposition = f.read()
+        with open(stream.name) as f:
+            events = [json.loads(line) for line in f]
+    assert 'endless_phase_calls_total{phase="entity_turn"} 1.0' in exposition
+    assert sorted(event["phase"] for event in events) == sorted(phase for phase in prometheus.phases for _ in range(prometheus.phases[phase].calls))
+
+def test_prometheus_sink_exports_while_enabled() -> None:
+    with tempfile.TemporaryDirectory() as directory:
+        periodic = instrumentation.PrometheusSink(os.path.join(directory, "periodic.prom"), interval=0)
+        on_demand = instrumentation.PrometheusSink(os.path.join(directory, "on_demand.prom"), interval=3600)
+        with instrumentation.Instrumentation(periodic):
+            main.entity_turn(main.TOMAR, main.STARTING_LABORATORY, 'shta')
+            assert os.path.exists(periodic.path)
+        with instrumentation.Instrumentation(on_demand) as instrumented:
+            main.entity_turn(main.TOMAR, main.STARTING_LABORATORY, 'shta')
+            assert not os.path.exists(on_demand.path)
+            instrumented.flush()
+            assert os.path.exists(on_demand.path)
+
+def test_buffered_output_writes_when_input_is_requested() -> None:
+    stream = io_module.StringIO()
+    output = io.BufferedOutput(stream)
+    inputs = iter(('1', '2'))
+    seen_before_input = []
+    def get_input() -> str:
+        seen_before_input.append(stream.getvalue())
+        return next(inputs)
+    main.main(output.wrap_input(get_input), output)
+    output.flush()
+    expected = TestOutputBuffer()
+    main.main(TestInputSource(('1', '2'), lambda text: None), expected)
+    assert stream.getvalue() == "".join(line + "\n" for line in expected.buffer)
+    assert seen_before_input[0].endswith("2) Quit\n") and seen_before_input[1].endswith("2) Quit\n")
+    assert seen_before_input[1] != seen_before_input[0]
+
+def test_buffered_output_flushes_at_threshold() -> None:
+    stream = io_module.StringIO()
+    output = io.BufferedOutput(stream, threshold=10)
+    output("12345")
+    assert stream.getvalue() == ""
+    output("6789")
+    assert stream.getvalue() == "12345\n6789\n"
+
+def test_non_blocking_output_never_blocks_on_a_full_pipe() -> None:
+    read_fd, write_fd = os.pipe()
+    try:
+        output = io.NonBlockingOutput(write_fd, threshold=1024)
+        line = "x" * 1023
+        for _ in range(1024):  # A megabyte, far more than a pipe holds
+            output(line)
+        assert output.unsent
+        received = bytearray()
+        while output.unsent or output.pending:
+            received += os.read(read_fd, 65536)
+            output.flush()
+        while len(received) < 1024 * 1024:
+            received += os.read(read_fd, 65536)
+        assert bytes(received) == (line + "\n").encode() * 1024
+        assert not os.get_blocking(write_fd)
+        with output:
+            output("done")
+        assert os.read(read_fd, 65536) == b"done\n" and os.get_blocking(write_fd)
+    finally:
+        os.close(read_fd)
+        os.close(write_fd)
+
+def test_transcripts_record_and_replay() -> None:
+    sequence = ('1', 'nonsense', '0', 'shta', 'nonsense', 'shak', 'shak', 'hello')
+    _, expected = try_sequence(main.main, sequence)
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "session.txt")
+        with io.TranscriptRecorder(TestInputSource(sequence, lambda text: None), path) as recorder:
+            try:
+                main.main(recorder, TestOutputBuffer())
+            except EndOfTest:
+                pass
+        with open(path, "ab") as f:
+            f.write(b"\n")  # Blank lines are skipped, as on stdin
+        for use_mmap in (False, True):
+            log = TestOutputBuffer()
+            with io.TranscriptInput(path, use_mmap, echo=log) as get_input:
+                try:
+                    main.main(get_input, log)
+                except EOFError:
+                    pass
+                assert get_input.commands_read == len(sequence)
+            assert log.buffer == expected
+
 if __name__ == "__main__":
-    print("Use nosetests on this file.")
+    parser = argparse.ArgumentParser(description="Use nosetests on this file, or run the input sequences sharded across processes.")
+    parser.add_argument("--compare", action="store_true", help="compare main.main against main2.main")
+    parser.add_argument("--length", type=int, default=10)
+    parser.add_argument("--processes", type=int, default=None)
+    parser.add_argument("--strict", action="store_true", help="also fail on parts of the game that aren't written yet")
+    args = parser.parse_args()
+    input_set = ['0', 'shta', 'shak', 'chai', 'reho', '2']
+    sequences = itertools.product(input_set, repeat=args.length)
+    if args.compare:
+        import main2
+        check = functools.partial(check_equivalence, main.main, main2.main)
+    else:
+        check = functools.partial(check_sequence, main.main, not args.strict)
+    failures = run_sharded(check, sequences, args.processes)
+    print("{} failures".format(len(failures)))
+    sys.exit(1 if failures else 0)